@@ -8,7 +8,7 @@
 from __future__ import absolute_import
 from . import nbtexels
 from .textmodel import textmodel
-from .textmodel import texeltree, styles
+from .textmodel import texeltree, styles, lazytext
 from .nbtexels import mk_textmodel
 
 import cerealizer
@@ -38,20 +38,23 @@ def dumps(obj):
 
 
 def _replace_styles(texel, table):
+    # Styles are stored as plain dicts. We replace them by interned
+    # styles and the line breaks by shared texels.
     if texel.is_group or texel.is_container:
-        for child in texel.childs:
+        childs = texel.childs
+        for k, child in enumerate(childs):
             _replace_styles(child, table)
+            childs[k] = texeltree.interned(child)
     else:
-        if 'style' in texel.__dict__:
-            sid = id(texel.style)
+        for name in ('style', 'parstyle'):
+            style = getattr(texel, name, None)
+            if style is None:
+                continue
+            sid = id(style)
             if not sid in table:
-                table[sid] = styles.create_style(**texel.style)
-            texel.style = table[sid]
-        if isinstance(texel, texeltree.NewLine) and 'parstyle' in texel.__dict__:
-            sid = id(texel.parstyle)
-            if not sid in table:
-                table[sid] = texel.parstyle = styles.create_style(**texel.parstyle)
-            texel.parstyle = table[sid]
+                table[sid] = styles.as_style(style)
+            if table[sid] is not style:
+                setattr(texel, name, table[sid])
 
 def loads(s):
     assert s.startswith(magic)
@@ -64,6 +67,9 @@ def loads(s):
 
 register(texeltree.Group)
 register(texeltree.Text)
+register(texeltree.Lines)
+register(texeltree.SharedText)
+register(lazytext.LazyText) # restored with the text in memory
 register(texeltree.Container)
 register(texeltree.NewLine)
 register(texeltree.Tabulator)
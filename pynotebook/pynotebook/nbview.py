@@ -5,14 +5,15 @@ from .textmodel import texeltree
 from .textmodel.textmodel import TextModel
 from .textmodel.styles import create_style, updated_style, EMPTYSTYLE
 from .textmodel.texeltree import Group, Text, groups, grouped, insert, \
-    length, get_text, join, get_rightmost, NULL_TEXEL, dump, iter_leaves
+    length, get_text, join, get_rightmost, NULL_TEXEL, dump, iter_leaves, \
+    digest
 from .textmodel.properties import overridable_property
 from .wxtextview.boxes import Box, VGroup, VBox, Row, Rect, check_box, \
     NewlineBox, TextBox, TabulatorBox, extend_range_seperated, replace_boxes, \
     ChildBox, calc_length
 from .wxtextview.simplelayout import create_paragraphs, Paragraph
 from .wxtextview.testdevice import TESTDEVICE
-from .wxtextview.builder import BuilderBase
+from .wxtextview.builder import BuilderBase, Factory
 from .wxtextview.wxdevice import WxDevice
 from .wxtextview.wxtextview import WXTextView as _WXTextView
 
@@ -441,12 +442,16 @@ class GraphicsBox(Box):
 
 
 class BoxesCache:
+    # Boxes are cached by the digests of their texels, so that equal
+    # cells share their boxes even if the texels are not identical.
     def __init__(self):
         self.buffer = dict()
         
     def set(self, key, box):
-        def callback(*args):
-            del self.buffer[key]        
+        def callback(ref):
+            # the key may have been taken over by another box
+            if self.buffer.get(key) is ref:
+                del self.buffer[key]
         self.buffer[key] = weakref.ref(box, callback)
         
     def get(self, key):
@@ -482,7 +487,7 @@ def find_temp(tree):
 
 
 
-class Builder(BuilderBase):
+class Builder(BuilderBase, Factory):
     parstyle = EMPTYSTYLE
     def __init__(self, model, clients=None, device=TESTDEVICE, maxw=0):
         if clients is None:
@@ -497,12 +502,12 @@ class Builder(BuilderBase):
         return self.device
 
     stylesheet = dict(
-        normal = dict(),
-        h0 = dict(fontsize=18, bold=True, role='title'),
-        h1 = dict(fontsize=16, bold=True, bgcolor="red", role='title'),
-        h2 = dict(fontsize=14, bold=True, role='title'),
-        h3 = dict(fontsize=12, bold=True, role='title'),
-        list = dict(indent=24, bullet='-')
+        normal = create_style(),
+        h0 = create_style(fontsize=18, bold=True, role='title'),
+        h1 = create_style(fontsize=16, bold=True, bgcolor="red", role='title'),
+        h2 = create_style(fontsize=14, bold=True, role='title'),
+        h3 = create_style(fontsize=12, bold=True, role='title'),
+        list = create_style(indent=24, bullet='-')
     )
     
     def mk_style(self, style):
@@ -510,9 +515,7 @@ class Builder(BuilderBase):
         # default behaviour is to use the paragraph style and add the
         # text styles.
         name = self.parstyle.get('base', 'normal')
-        r = self.stylesheet[name].copy()
-        r.update(style)
-        return r
+        return updated_style(self.stylesheet[name], style)
 
     def extended_texel(self):
         return self.model.get_xtexel()
@@ -528,9 +531,8 @@ class Builder(BuilderBase):
 
     ### Factory methods
     def create_boxes(self, texel):
-        name = texel.__class__.__name__+'_handler'
-        handler = getattr(self, name)
-        #print "calling handler", name
+        handler = self.get_handler(texel)
+        #print "calling handler", handler
         l = handler(texel)
         try:
             assert calc_length(l) == length(texel)
@@ -561,7 +563,7 @@ class Builder(BuilderBase):
     _textcache_keys = []
     def Text_handler(self, texel):
         # caching version
-        key = texel.text, id(texel.style), id(self.parstyle), self.device
+        key = texel.text, texel.style.sid, self.parstyle.sid, self.device
         try:
             return self._textcache[key]
         except: pass        
@@ -574,6 +576,9 @@ class Builder(BuilderBase):
         self._textcache[key] = r
         return r
     
+    def Lines_handler(self, texel):
+        return self.create_lines(texel, texel.text)
+
     def NewLine_handler(self, texel):
         self.parstyle = texel.parstyle
         if texel.is_endmark:
@@ -585,11 +590,11 @@ class Builder(BuilderBase):
 
     def TextCell_handler(self, texel):
         try:
-            cell = self.cache.get(texel)
+            cell = self.cache.get(digest(texel))
         except KeyError:
             textbox = self.create_parstack(Group(texel.childs[1:]))
             cell = TextCellBox(textbox, device=self.device)
-            self.cache.set(texel, cell)
+            self.cache.set(digest(texel), cell)
         assert len(cell) == length(texel)
         return [cell]
 
@@ -600,7 +605,7 @@ class Builder(BuilderBase):
         inbackground = ScriptingCellBox.inbackground
         inline = ScriptingCellBox.inline
 
-        key = inp, 'input'
+        key = digest(inp), texel.client_name, 'input'
         try:
             inbox = self.cache.get(key)
         except KeyError:        
@@ -622,7 +627,7 @@ class Builder(BuilderBase):
             self.cache.set(key, inbox)
             assert len(inbox) == length(inp)+1
 
-        key = outp, 'out'
+        key = digest(outp), 'out'
         try:
             outbox = self.cache.get(key)
         except KeyError:
@@ -696,6 +701,9 @@ class Builder(BuilderBase):
         #print "removed", i, n
         self.rebuild()
 
+    def replaced(self, i1, i2, n):
+        self.rebuild()
+
 
 
 
@@ -952,11 +960,8 @@ class NBView(_WXTextView):
                                  client.counter)
         assert i0>=0
         assert i0+n<=len(self.model)
-        infos = []
-        infos.append(self._remove(i0, i0+n))
-        self.model.insert(i0, mk_textmodel(new))
-        infos.append((self._remove, i0, i0+length(new)))
-        self.add_undo(infos) 
+        self.apply_edits([(i0, i0+n, mk_textmodel(new))])
+        self.index = i0+length(new)
         self.adjust_viewport()
         return result
 
@@ -0,0 +1,266 @@
+# -*- coding: latin-1 -*-
+
+# Little benchmark utility for textmodel
+#
+# usage:
+# - write a function to benchmark, e.g. test_00
+# - call python runtests.py --profile demo/benchmark.py test_00
+# - or call python demo/benchmark.py to print the tables
+
+
+from __future__ import print_function
+import sys
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+
+import time
+from textmodel import TextModel, TextModelBuilder
+
+
+def keystroke_latency(n, count=200):
+    # Average time for typing a character into the middle of a
+    # single run of *n* characters.
+    model = TextModel(u'x'*n)
+    i = n // 2
+    t0 = time.time()
+    for k in range(count):
+        model.insert_text(i+k, u'a')
+    return (time.time()-t0)/count
+
+
+def print_keystroke_latency():
+    print("=============== ====================")
+    print("  run length     time (milliseconds)")
+    print("=============== ====================")
+    for n in (1000, 10000, 100000, 1000000, 10000000, 50000000):
+        print("%15i %15.6f" % (n, 1000*keystroke_latency(n)))
+    print("=============== ====================")
+
+
+def cursor_moves(nlines=100000, count=10000):
+    # Average time for index2position and get_style at random indices
+    import random
+    model = TextModel(u''.join([u"Line %i: test test test test\n" % i
+                               for i in range(nlines)]))
+    n = len(model)
+    indices = [random.randrange(n) for i in range(count)]
+    t0 = time.time()
+    for i in indices:
+        model.index2position(i)
+        model.get_style(i)
+    return (time.time()-t0)/count
+
+
+def caret_info(nlines=100000, count=10000):
+    # Average time for collecting style, paragraph style and position
+    # at the cursor, as done by TextView.handle_action
+    import random
+    model = TextModel(u''.join([u"Line %i: test test test test\n" % i
+                               for i in range(nlines)]))
+    n = len(model)
+    indices = [random.randrange(1, n) for i in range(count)]
+    t0 = time.time()
+    for i in indices:
+        model.locate_many([i-1, i])
+    return (time.time()-t0)/count
+
+
+def build_oneshot(nlines=10000):
+    t = u''.join([u"Line %i: test test test test\n" % i for i in range(nlines)])
+    return TextModel(t)
+
+
+def build_streaming(nlines=10000, chunksize=1):
+    # chunksize is the number of lines per chunk
+    builder = TextModelBuilder()
+    for i in range(0, nlines, chunksize):
+        builder.append_text(u''.join(
+            [u"Line %i: test test test test\n" % j
+             for j in range(i, min(nlines, i+chunksize))]))
+    return builder.get_model()
+
+
+def build_appending(nlines=10000):
+    model = TextModel()
+    for i in range(nlines):
+        model.append(TextModel(u"Line %i: test test test test\n" % i))
+    return model
+
+
+def build_appending_text(nlines=10000):
+    model = TextModel()
+    for i in range(nlines):
+        model.append_text(u"Line %i: test test test test\n" % i)
+    model.texel # join the appended content with the tree
+    return model
+
+
+def count_texels(texel):
+    n = 1
+    if texel.is_group or texel.is_container:
+        for child in texel.childs:
+            n += count_texels(child)
+    return n
+
+
+def build_logfile(nlines=1000000):
+    # Number of texels needed for a plain text document
+    return count_texels(build_oneshot(nlines).texel)
+
+
+def alternating_runs(nruns=100000):
+    builder = TextModelBuilder()
+    for i in range(nruns):
+        builder.append_text(u"word ", dict(fontsize=i%5+8))
+    return builder.get_model()
+
+
+def recolor(nruns=100000):
+    # Time for setting a property on *nruns* differently styled runs
+    model = alternating_runs(nruns)
+    t0 = time.time()
+    model.set_properties(0, len(model), textcolor='red')
+    return time.time()-t0
+
+
+def style_runs(nruns=100000):
+    # Time for extracting *nruns* style runs
+    from textmodel.styles import get_styles
+    model = alternating_runs(nruns)
+    t0 = time.time()
+    get_styles(model.texel, 0, len(model))
+    return time.time()-t0
+
+
+def extract_text(nlines=1000000):
+    # Time for get_text on a document of *nlines* lines
+    model = build_oneshot(nlines)
+    t0 = time.time()
+    model.get_text(10, len(model)-10)
+    return time.time()-t0
+
+
+def copy_latency(nlines=1000000, count=1000):
+    # Average time for copying 100 characters out of a large document
+    model = build_oneshot(nlines)
+    i = len(model) // 2
+    t0 = time.time()
+    for k in range(count):
+        model.copy(i+k, i+k+100)
+    return (time.time()-t0)/count
+
+
+def memory_per_char(nruns=100000):
+    # Bytes allocated per character for a document with *nruns*
+    # differently styled runs
+    import tracemalloc
+    tracemalloc.start()
+    model = alternating_runs(nruns)
+    model.texel
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return float(size)/len(model)
+
+
+def replace_all(nlines=100000):
+    # Time for replacing one word in each of *nlines* lines (14 MB)
+    model = TextModel(u''.join([u"Line %i: test foo %s\n" % (i, u"test "*25)
+                               for i in range(nlines)]))
+    t0 = time.time()
+    model.replace_all(u"foo", u"barbaz")
+    return time.time()-t0
+
+
+def colorize():
+    # Syntax highlighting of the texeltree module (1600 lines)
+    import os
+    from textmodel.textmodel import pycolorize
+    filename = os.path.join(os.path.dirname(__file__), '..', 'textmodel',
+                            'texeltree.py')
+    return pycolorize(open(filename, 'rb').read())
+
+
+def test_00(): # 0.04ms per keystroke
+    keystroke_latency(1000)
+
+def test_01(): # 0.2ms per keystroke (was 25ms before leaves were bounded)
+    keystroke_latency(50000000)
+
+def test_02(): # 0.16s (0.5s before prefix sums in groups)
+    cursor_moves()
+
+def test_03(): # 0.004s (0.03s with one NewLine per line)
+    build_oneshot()
+
+def test_04(): # 0.06s (one line per chunk), 0.045s (100 lines per chunk)
+    build_streaming()
+
+def test_05(): # 0.24s (1.3s when append went through insert)
+    build_appending()
+
+def test_06(): # 4.2s, bulk building takes 0.6s
+    build_appending_text(1000000)
+
+
+def test_07(): # 0.4s, 35k texels (7s and 2.2M texels with one
+                # NewLine per line)
+    build_logfile()
+
+
+def test_08(): # 1.1s (2.3s with a quadratic set_styles), of which
+                # 0.08s are spent in updated_style (0.25s before
+                # transitions were memoized)
+    recolor()
+
+
+def test_09(): # 0.12s (2.3s with one set_properties call per token)
+    colorize()
+
+
+def test_10(): # 0.21s
+    style_runs()
+
+
+def test_11(): # 0.15s (0.4s with get_style, get_parstyle and
+                # index2position)
+    caret_info()
+
+
+def test_12(): # 0.036s (0.13s with one join per tree level)
+    extract_text()
+
+
+def test_13(): # 0.04ms per copy (0.25ms when copy went through takeout)
+    copy_latency()
+
+
+def test_14(): # 25.5 bytes per character (47.1 bytes with dict based
+                # texels and a weights tuple per leaf)
+    memory_per_char()
+
+
+def test_15(): # 3.1s (25s with takeout and insert per match)
+    replace_all()
+
+
+def timeit(f, *args):
+    t0 = time.time()
+    f(*args)
+    return time.time()-t0
+
+
+if __name__ == '__main__':
+    print_keystroke_latency()
+    print("cursor move: %f ms" % (1000*cursor_moves()))
+    print("caret info: %f ms" % (1000*caret_info()))
+    for f in (build_oneshot, build_streaming, build_appending,
+              build_appending_text):
+        print("%s: %f s" % (f.__name__, timeit(f)))
+    print("texels for 1M lines: %i" % build_logfile())
+    print("recolor 100k runs: %f s" % recolor())
+    print("get_styles 100k runs: %f s" % style_runs())
+    print("colorize: %f s" % timeit(colorize))
+    print("get_text 1M lines: %f s" % extract_text())
+    print("copy: %f ms" % (1000*copy_latency()))
+    print("memory: %.1f bytes per character" % memory_per_char())
+    print("replace all 100k matches: %f s" % replace_all())
@@ -2,7 +2,8 @@ import sys
 sys.path.insert(0, '..')
 
 from textmodel import TextModel
-from textmodel.texeltree import Texel, T, TAB, NL, Container, dump, get_text, NewLine
+from textmodel.texeltree import Texel, T, TAB, NL, Container, dump, get_text, NewLine, \
+    Lines, explode
 from textmodel.styles import create_style
 
 
@@ -20,6 +21,9 @@ def print_rst(text):
             for child in obj.childs:
                 r.extend(get_pieces(child))
             return r
+        if isinstance(obj, Lines):
+            # newlines in text leaves become NewLine texels
+            return explode(obj)
         return [obj]
 
     
@@ -57,7 +61,7 @@ def print_rst(text):
 T = MyTextModel
 
 bullet = T('\n')
-bullet.texel.parstyle = create_style(listlevel=1)
+bullet.set_parproperties(0, 1, listlevel=1)
 
 text = T()
 text += T("Wonderful world of textmodel:\n")
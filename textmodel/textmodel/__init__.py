@@ -1,3 +1,3 @@
-from .textmodel import TextModel
+from .textmodel import TextModel, TextModelBuilder
 
 
@@ -0,0 +1,243 @@
+# -*- coding: latin-1 -*-
+
+
+from .texeltree import SharedText, length, provides_childs
+from bisect import bisect_left, bisect_right
+
+
+class TexelCursor:
+    """A position in a textmodel for sequential traversal.
+
+    The cursor keeps the path from the root to the current leaf, so
+    that moving to a neighbouring character or leaf costs amortized
+    O(1) instead of a descent from the root. When the model has been
+    changed, the cursor is moved to its old index in the new tree
+    (or to the end, if the text has become shorter).
+
+    >>> from .textmodel import TextModel
+    >>> cursor = TexelCursor(TextModel("Hello world"), 3)
+    >>> cursor.skip_forward(lambda c: c.isalnum())
+    5
+    """
+    def __init__(self, model, i=0):
+        self.model = model
+        self.seek(i)
+
+    def seek(self, i):
+        """Moves the cursor to index *i*."""
+        root = self.model.texel
+        if not 0 <= i <= length(root):
+            raise IndexError(i)
+        self._root = root
+        self.index = i
+        path = [] # entries [group, k]
+        texel = root
+        if i < length(root):
+            while provides_childs(texel):
+                offsets = texel.cumulated[1]
+                k = bisect_right(offsets, i)-1
+                path.append([texel, k])
+                i -= offsets[k]
+                texel = texel.childs[k]
+        else:
+            texel = None # at the end
+        self._path = path
+        self._leaf = texel
+        self._offset = i
+
+    def _check(self):
+        if self.model.texel is not self._root:
+            # the model has been changed
+            self.seek(min(self.index, len(self.model)))
+
+    def _char(self):
+        leaf = self._leaf
+        if leaf.__class__ is SharedText:
+            # avoid slicing the leaf text for every character
+            return leaf.buffer[leaf.start+self._offset]
+        if leaf.is_text:
+            return leaf.text[self._offset]
+        return leaf.text
+
+    def get_leaf(self):
+        """Returns the leaf right of the cursor and the offset in it.
+
+           At the end of the text, the leaf is None.
+        """
+        self._check()
+        return self._leaf, self._offset
+
+    def next_char(self):
+        """Returns the character right of the cursor and moves behind it.
+
+           Raises IndexError at the end of the text.
+        """
+        self._check()
+        leaf = self._leaf
+        if leaf is None:
+            raise IndexError(self.index)
+        c = self._char()
+        self.index += 1
+        self._offset += 1
+        if self._offset >= length(leaf):
+            self._next_leaf()
+        return c
+
+    def prev_char(self):
+        """Moves one character back and returns it.
+
+           Raises IndexError at the start of the text.
+        """
+        self._check()
+        if self.index == 0:
+            raise IndexError(-1)
+        if self._leaf is None:
+            self.seek(self.index-1)
+        else:
+            if self._offset == 0:
+                self._prev_leaf()
+            self._offset -= 1
+            self.index -= 1
+        return self._char()
+
+    def next_leaf(self):
+        """Moves to the start of the next leaf and returns it.
+
+           Returns None if there is no next leaf. The cursor is then
+           at the end of the text.
+        """
+        self._check()
+        if self._leaf is None:
+            return None
+        self.index += length(self._leaf)-self._offset
+        return self._next_leaf()
+
+    def skip_forward(self, test):
+        """Moves forward while *test* is true for the next character.
+
+           Returns the new index.
+        """
+        try:
+            while test(self.next_char()):
+                pass
+            self.prev_char()
+        except IndexError:
+            pass
+        return self.index
+
+    def skip_backward(self, test):
+        """Moves backward while *test* is true for the previous character.
+
+           Returns the new index.
+        """
+        try:
+            while test(self.prev_char()):
+                pass
+            self.next_char()
+        except IndexError:
+            pass
+        return self.index
+
+    def _next_leaf(self):
+        # Moves to the start of the next non empty leaf
+        path = self._path
+        while path:
+            entry = path[-1]
+            group, k = entry
+            k += 1
+            if k == len(group.childs):
+                path.pop()
+                continue
+            entry[1] = k
+            texel = group.childs[k]
+            if not length(texel):
+                continue
+            while provides_childs(texel):
+                # first non empty child
+                k = bisect_right(texel.cumulated[1], 0)-1
+                path.append([texel, k])
+                texel = texel.childs[k]
+            self._leaf = texel
+            self._offset = 0
+            return texel
+        self._leaf = None
+        self._offset = 0
+        return None
+
+    def _prev_leaf(self):
+        # Moves to the end of the previous non empty leaf
+        path = self._path
+        while path:
+            entry = path[-1]
+            group, k = entry
+            k -= 1
+            if k < 0:
+                path.pop()
+                continue
+            entry[1] = k
+            texel = group.childs[k]
+            if not length(texel):
+                continue
+            while provides_childs(texel):
+                # last non empty child
+                offsets = texel.cumulated[1]
+                k = bisect_left(offsets, offsets[-1])-1
+                path.append([texel, k])
+                texel = texel.childs[k]
+            self._leaf = texel
+            self._offset = length(texel)
+            return texel
+        raise IndexError(self.index)
+
+
+
+def test_00():
+    "next_char / prev_char"
+    from .textmodel import TextModel
+    from . import texeltree
+    text = "Hello\nworld,\tthis is a test\n"*10
+    for nmax in (4, 16):
+        texeltree.set_nmax(nmax)
+        model = TextModel(text)
+        if nmax == 4: # one leaf per character
+            model.texel = texeltree.grouped(
+                [TextModel(c).texel for c in text])
+        model.set_properties(10, 30, bold=True)
+        model.set_parproperties(20, 40, base='h1')
+        n = len(model)
+        cursor = TexelCursor(model)
+        for i in range(n):
+            assert cursor.index == i
+            assert cursor.next_char() == text[i]
+        assert cursor.index == n
+        for i in reversed(range(n)):
+            assert cursor.prev_char() == text[i]
+            assert cursor.index == i
+        for i in (0, 7, n-1, n):
+            cursor.seek(i)
+            assert cursor.index == i
+            if i:
+                assert cursor.prev_char() == text[i-1]
+    texeltree.set_nmax(16)
+
+def test_01():
+    "skip, next_leaf and changes"
+    from .textmodel import TextModel
+    model = TextModel("Hello, world!")
+    model.set_properties(3, 4, bold=True)
+    isalnum = lambda c: c.isalnum()
+    cursor = TexelCursor(model, 9)
+    assert cursor.skip_backward(isalnum) == 7
+    assert cursor.skip_forward(lambda c:True) == len(model)
+    assert cursor.skip_backward(lambda c:True) == 0
+    assert cursor.next_leaf().text == 'l'
+    assert cursor.index == 3
+    model.remove(0, 2)
+    assert cursor.next_char() == ','
+    model.remove(0, len(model))
+    assert cursor.get_leaf()[0] is None
+    try:
+        cursor.next_char()
+        assert False
+    except IndexError:
+        pass
@@ -0,0 +1,360 @@
+# -*- coding: latin-1 -*-
+
+"""Text leaves backed by a memory mapped file.
+
+A file is mapped into memory and scanned once for newlines. The tree
+is built from large LazyText leaves, which only store the byte range
+of their text. The text is decoded when a leaf is accessed, e.g. by
+get_text, the layout or a search. Like in a piece table, an edit
+splits a lazy leaf into lazy leaves for the untouched ranges and
+ordinary leaves for the edited parts. A large file can therefore be
+viewed and edited without loading it completely, and the tree only
+grows with the number of edits and tabulators.
+"""
+
+
+from .texeltree import Lines, Tabulator, TreeBuilder, EMPTYSTYLE, \
+    as_style, interned, text_leaves, _plain_styles
+from . import texeltree
+from collections import OrderedDict
+import threading
+import importlib
+import encodings
+import codecs
+import mmap
+
+
+_ascii = u''.join([chr(i) for i in range(128)])
+
+def _is_utf8(encoding):
+    # Returns True for utf-8 and False for ASCII compatible single
+    # byte encodings. Other encodings raise ValueError, since their
+    # multi byte sequences can't be found by looking at single bytes.
+    name = codecs.lookup(encoding).name
+    if name == 'utf-8':
+        return True
+    if name in ('ascii', 'iso8859-1'):
+        return False
+    try:
+        module = importlib.import_module(
+            'encodings.'+encodings.normalize_encoding(name))
+        table = module.decoding_table
+    except (ImportError, AttributeError):
+        table = None
+    if table is None or len(table) != 256 or table[:128] != _ascii:
+        raise ValueError("unsupported encoding: %s" % encoding)
+    return False
+
+
+class MappedFile:
+    """A read only memory map of a file with a cache of decoded
+       chunks.
+
+       Supported are utf-8 and the ASCII compatible single byte
+       encodings (e.g. latin-1 or cp1252).
+
+       The file must not be truncated while it is mapped, e.g. by a
+       log rotation. Reading the missing part would raise SIGBUS. The
+       map is released by close or when the MappedFile is used as
+       context manager. Leaves of a closed file can't be read anymore.
+    """
+    def __init__(self, filename, encoding='utf-8', cache_size=64):
+        self.is_utf8 = _is_utf8(encoding)
+        self.filename = filename
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self._cache = OrderedDict() # (start, end) -> text
+        self._lock = threading.Lock() # snapshots are read from threads
+        with open(filename, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                self.data = b''
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Releases the memory map."""
+        with self._lock:
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
+            self._cache.clear()
+
+    def decode(self, start, end):
+        """Returns the text of the bytes between *start* and *end*
+           without carriage returns."""
+        key = start, end
+        cache = self._cache
+        with self._lock:
+            text = cache.pop(key, None)
+            if text is None:
+                text = self.data[start:end].decode(
+                    self.encoding, 'surrogateescape').replace(u'\r', u'')
+                if len(cache) >= self.cache_size:
+                    cache.popitem(last=False)
+            cache[key] = text
+        return text
+
+    def offset(self, start, text, i):
+        """Returns the position of the byte which holds character *i*
+           of *text*. *Text* has been decoded from the bytes starting
+           at *start*."""
+        prefix = text[:i]
+        if self.is_utf8 and not prefix.isascii():
+            n = len(prefix.encode(self.encoding, 'surrogateescape'))
+        else:
+            n = i
+        # the removed carriage returns are added again
+        data = self.data
+        cr = 0
+        while True:
+            k = data[start:start+n+cr].count(b'\r')
+            if k == cr:
+                return start+n+cr
+            cr = k
+
+
+class _TextSource:
+    # Source of restored lazy leaves, which keep their text in
+    # memory. Positions are character indices.
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def decode(self, start, end):
+        return self.text[start:end]
+
+    def offset(self, start, text, i):
+        return start+i
+
+
+class LazyText(Lines):
+    """A text leaf whose text is stored in a MappedFile.
+
+       Carriage returns are not part of the text, as in TextModel.
+       Unlike other text leaves, lazy leaves can be longer than
+       maxtext. They are never merged. Slicing returns lazy leaves for
+       long ranges and ordinary leaves of at most maxtext characters
+       for short ones.
+    """
+    __slots__ = ('source', 'start', 'end')
+
+    def __init__(self, source, start, end, n, nlines, style=EMPTYSTYLE):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.style = style
+        self.weights = (0, n, nlines)
+        self._linestarts = None
+
+    @property
+    def text(self):
+        return self.source.decode(self.start, self.end)
+
+    def __repr__(self):
+        return "LazyText(%i, %i)" % (self.start, self.end)
+
+    def slice(self, i1, i2):
+        if i1 == 0 and i2 == self.weights[1]:
+            return [self]
+        text = self.text
+        if i2-i1 <= texeltree.maxtext:
+            return text_leaves(text[i1:i2], self.style)
+        source = self.source
+        start = source.offset(self.start, text, i1)
+        end = source.offset(self.start, text, i2)
+        return [LazyText(source, start, end, i2-i1,
+                         text.count(u'\n', i1, i2), self.style)]
+
+    def __getstate__(self):
+        # Only the text is stored. Restored leaves keep it in memory
+        # but are sliced like mapped ones.
+        return _plain_styles(dict(text=self.text, style=self.style))
+
+    def __setstate__(self, state):
+        text = state['text']
+        LazyText.__init__(self, _TextSource(text), 0, len(text), len(text),
+                          text.count(u'\n'), as_style(state['style']))
+
+
+def map_file(source, encoding='utf-8', style=EMPTYSTYLE, chunk_size=65536):
+    """Returns a texel for the content of *source*, which is a file
+       name or a MappedFile.
+
+       The file is scanned for newlines in chunks of *chunk_size*
+       bytes. Each chunk becomes a LazyText leaf, tabs are represented
+       by Tabulator texels.
+    """
+    if not isinstance(source, MappedFile):
+        source = MappedFile(source, encoding)
+    encoding = source.encoding
+    data = source.data
+    size = len(data)
+    builder = TreeBuilder()
+    tab = interned(Tabulator(style))
+    start = 0
+    while start < size:
+        end = min(start+chunk_size, size)
+        if end < size and source.is_utf8:
+            # don't split multi byte characters
+            while end > start and 0x80 <= data[end] < 0xc0:
+                end -= 1
+            if end == start:
+                end = min(start+chunk_size, size)
+        chunk = data[start:end]
+        p = 0
+        while True:
+            q = chunk.find(b'\t', p)
+            stop = len(chunk) if q < 0 else q
+            if stop > p:
+                part = chunk[p:stop]
+                if part.isascii() or not source.is_utf8:
+                    n = len(part)-part.count(b'\r')
+                else:
+                    n = len(part.decode(encoding, 'surrogateescape')
+                            .replace(u'\r', u''))
+                if n:
+                    builder.append(LazyText(source, start+p, start+stop, n,
+                                            part.count(b'\n'), style))
+            if q < 0:
+                break
+            builder.append(tab)
+            p = q+1
+        start = end
+    return builder.get_texel()
+
+
+
+def test_00():
+    "map_file"
+    import os
+    import tempfile
+    import pickle
+    from .textmodel import TextModel
+    from .texeltree import length, iter_leaves
+    text = u"".join([u"Zeile %i: \xe4\xf6\xfc \u20ac\tx\r\n" % i
+                     for i in range(200)])
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(text.encode('utf-8'))
+    try:
+        text = text.replace(u'\r', u'')
+        for chunk_size in (7, 100, 65536):
+            model = TextModel()
+            model.texel = map_file(filename, chunk_size=chunk_size)
+            assert model.get_text() == text
+            assert model.nlines() == text.count(u'\n')+1
+            assert model.get_text(50, 1000) == text[50:1000]
+            model = TextModel.from_file(filename)
+            assert model.get_text() == text
+            assert list(model.finditer(u"Zeile 7:")) == \
+                [(text.index(u"Zeile 7:"), text.index(u"Zeile 7:")+8)]
+            model.insert_text(10, u"abc")
+            model.remove(100, 200)
+            model.set_properties(300, 400, bold=True)
+            text2 = text[:10]+u"abc"+text[10:]
+            text2 = text2[:100]+text2[200:]
+            assert model.get_text() == text2
+            assert model.get_style(350)['bold']
+            model = pickle.loads(pickle.dumps(model))
+            assert model.get_text() == text2
+
+        # slices of a lazy leaf
+        with open(filename, 'wb') as f:
+            f.write(text.replace(u'\t', u' ').replace(u'\n', u'\r\n')
+                    .encode('utf-8'))
+        with MappedFile(filename) as source:
+            texel = map_file(source, chunk_size=3000)
+            leaves = [leaf for i1, i2, leaf in iter_leaves(texel)]
+            assert len(leaves) > 1
+            for leaf in leaves:
+                assert isinstance(leaf, LazyText)
+            leaf = leaves[1]
+            restored = pickle.loads(pickle.dumps(leaf))
+            assert restored.text == leaf.text
+            assert restored.weights == leaf.weights
+            n = length(leaf)
+            for texel in (leaf, restored):
+                for i1, i2 in ((0, n), (3, n), (0, n-3), (5, 10),
+                               (20, n-20), (100, 1200)):
+                    pieces = texel.slice(i1, i2)
+                    t = texel.text[i1:i2]
+                    assert u"".join([p.text for p in pieces]) == t
+                    assert sum([length(p) for p in pieces]) == i2-i1
+                    assert sum([p.weights[2] for p in pieces]) == \
+                        t.count(u'\n')
+                    if i2-i1 > texeltree.maxtext:
+                        assert [p.__class__ for p in pieces] == [LazyText]
+                        m = i2-i1
+                        assert pieces[0].slice(1, m)[0].text == t[1:m]
+                    else:
+                        for p in pieces:
+                            assert length(p) <= texeltree.maxtext
+    finally:
+        os.remove(filename)
+
+
+def test_01():
+    "empty file and encodings"
+    import os
+    import tempfile
+    from .textmodel import TextModel
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        assert TextModel.from_file(filename).get_text() == u""
+        with open(filename, 'wb') as f:
+            f.write(u"\xe4\xf6\xfc\n".encode('latin-1'))
+        model = TextModel.from_file(filename, 'latin-1')
+        assert model.get_text() == u"\xe4\xf6\xfc\n"
+        model = TextModel.from_file(filename, 'cp1252')
+        assert model.get_text() == u"\xe4\xf6\xfc\n"
+        for encoding in ('utf-16', 'gbk', 'shift_jis', 'cp037'):
+            try:
+                TextModel.from_file(filename, encoding)
+                assert False
+            except ValueError:
+                pass
+    finally:
+        os.remove(filename)
+
+
+def test_02():
+    "memory of large files"
+    import os
+    import tempfile
+    import tracemalloc
+    from .textmodel import TextModel
+    from .texeltree import iter_leaves
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    sizes = []
+    try:
+        for n in (10000, 100000):
+            with open(filename, 'wb') as f:
+                f.write(b"a line of a large log file\n"*n)
+            tracemalloc.start()
+            try:
+                model = TextModel.from_file(filename)
+                model.insert_text(len(model)//2, u"abc")
+                model.remove(1000, 2000)
+                sizes.append(tracemalloc.get_traced_memory()[0])
+            finally:
+                tracemalloc.stop()
+            assert len(model) == 27*n-997
+            leaves = list(iter_leaves(model.texel))
+            assert len(leaves) < 27*n // 65536+10
+            del model, leaves
+        # 10 times larger file, but the tree size is nearly the same
+        assert sizes[1] < sizes[0]+20000
+    finally:
+        os.remove(filename)
@@ -0,0 +1,304 @@
+# -*- coding: latin-1 -*-
+
+
+from .texeltree import length, provides_childs, iter_text
+from weakref import WeakKeyDictionary
+import re
+
+
+def compile_pattern(pattern):
+    """Returns a compiled regular expression for *pattern*.
+
+       Strings are searched literally, compiled regular expressions
+       are returned unchanged.
+    """
+    if isinstance(pattern, str):
+        return re.compile(re.escape(pattern))
+    return pattern
+
+
+def finditer(texel, pattern, i1=0, i2=None, reverse=False, chunk_size=65536,
+             overlap=256):
+    """Yields the index pairs (j1, j2) of all matches of *pattern* in
+       *texel* between *i1* and *i2*.
+
+       The text is read in chunks of *chunk_size* characters. Each
+       chunk is extended by *overlap* characters, so that matches
+       crossing chunk boundaries are found. For strings, the overlap
+       is raised to the length of the string. Regular expressions
+       must not look back further than *overlap* characters and
+       should not match more than *overlap* characters. Longer
+       matches are found only if they reach the end of the window; the
+       window is then extended.
+
+       With *reverse*, the chunks are searched from *i2* backwards
+       and the matches of each chunk are yielded in reverse order, so
+       that finding the previous match doesn't search the whole
+       range. As in forward direction, each chunk is searched from
+       *overlap* characters before its start on. Matches which overlap
+       an already yielded match are skipped. For patterns whose
+       matches can't overlap, e.g. most strings, the matches are the
+       same as in forward direction.
+    """
+    rx = compile_pattern(pattern)
+    if isinstance(pattern, str):
+        overlap = max(overlap, len(pattern)-1)
+    n = length(texel)
+    if i2 is None:
+        i2 = n
+    if not 0 <= i1 <= i2 <= n:
+        raise IndexError((i1, i2))
+    if reverse:
+        limit = i2 # matches must end before limit
+        b = i2
+        while b > i1:
+            a = max(i1, b-chunk_size)
+            found = _search_chunk(texel, rx, max(i1, a-overlap), b, i1, i2,
+                                  overlap)
+            for j1, j2 in reversed(found):
+                if j1 >= a and j2 <= limit:
+                    yield j1, j2
+                    limit = j1
+            b = a
+        return
+    pos = i1 # matches must not start before pos
+    for a in range(i1, i2, chunk_size):
+        b = min(a+chunk_size, i2)
+        for j1, j2 in _search_chunk(texel, rx, max(pos, a), b, i1, i2,
+                                    overlap):
+            yield j1, j2
+            pos = max(j2, j1+1) # empty matches advance by one
+
+
+def _search_chunk(texel, rx, a, b, i1, i2, overlap):
+    # Returns all matches starting between a and b
+    c = max(i1, a-overlap) # context for look behind
+    e = min(i2, b+overlap)
+    text = u''.join(iter_text(texel, c, e))
+    r = []
+    p = a-c
+    while p <= b-c:
+        m = rx.search(text, p)
+        if m is None or m.start() >= b-c:
+            break
+        if m.end() == len(text) and e < i2:
+            # the match might continue after the window
+            e = min(i2, e+max(overlap, len(text)))
+            text = u''.join(iter_text(texel, c, e))
+            continue
+        r.append((c+m.start(), c+m.end()))
+        p = max(m.end(), m.start()+1)
+    return r
+
+
+class SearchIndex:
+    """Finds all occurrences of a string and keeps the results for
+       each group.
+
+       The results are kept as long as the groups exist. Since an edit
+       only replaces the groups along the changed paths, searching
+       again after a local change costs O(log(n)) plus the number of
+       matches.
+
+       >>> from .textmodel import TextModel
+       >>> index = SearchIndex("ab")
+       >>> list(index.finditer(TextModel("abcab")))
+       [(0, 2), (3, 5)]
+    """
+    def __init__(self, text):
+        if not text:
+            raise ValueError("empty search text")
+        self.text = text
+        self._cache = WeakKeyDictionary() # group -> (starts, count)
+
+    def finditer(self, model, i1=0, i2=None, reverse=False):
+        """Yields the index pairs (j1, j2) of the occurrences in *model*
+           between *i1* and *i2*.
+
+           Overlapping occurrences are skipped, as in finditer.
+        """
+        texel = model.texel
+        if i2 is None:
+            i2 = length(texel)
+        if not 0 <= i1 <= i2 <= length(texel):
+            raise IndexError((i1, i2))
+        n = len(self.text)
+        r = []
+        end = i1
+        for j in self._iter_starts(texel, 0, i1, i2-n):
+            if j >= end:
+                r.append((j, j+n))
+                end = j+n
+        if reverse:
+            r.reverse()
+        return iter(r)
+
+    def count(self, model):
+        """Returns the number of occurrences in *model*, including
+           overlapping ones."""
+        return self._get_entry(model.texel)[1]
+
+    def _iter_starts(self, texel, j0, i1, i2):
+        # Yields the sorted start positions between i1 and i2.
+        if not provides_childs(texel):
+            # only happens at the root
+            for j in _find_all(texel.text, self.text):
+                if i1 <= j <= i2:
+                    yield j
+            return
+        starts, count = self._get_entry(texel)
+        if not count:
+            return
+        offsets = texel.cumulated[1]
+        k = 0
+        for child, o1, o2 in zip(texel.childs, offsets, offsets[1:]):
+            if j0+o2 <= i1:
+                continue
+            if j0+o1 > i2:
+                break
+            if provides_childs(child):
+                for j in self._iter_starts(child, j0+o1, i1, i2):
+                    yield j
+            # starts inside the leaf and across the boundary to the
+            # next child
+            while k < len(starts) and starts[k] < o2:
+                j = j0+starts[k]
+                if i1 <= j <= i2:
+                    yield j
+                k += 1
+
+    def _get_entry(self, texel):
+        # Returns the sorted starts of all occurrences in *texel*,
+        # which are not inside a child group, and the total number of
+        # occurrences.
+        text = self.text
+        n = len(text)
+        if not provides_childs(texel):
+            starts = _find_all(texel.text, text)
+            return starts, len(starts)
+        try:
+            return self._cache[texel]
+        except KeyError:
+            pass
+        starts = []
+        count = 0
+        prev = 0 # the previous child boundary
+        offsets = texel.cumulated[1]
+        for child, o1, o2 in zip(texel.childs, offsets, offsets[1:]):
+            if o1 > 0:
+                # Occurrences crossing the boundary at o1 are stored
+                # here, if they don't cross an earlier boundary.
+                a = max(prev, o1-n+1)
+                b = min(length(texel), o1+n-1)
+                if b-a >= n:
+                    window = u''.join(iter_text(texel, a, b))
+                    for j in _find_all(window, text):
+                        if a+j < o1:
+                            starts.append(a+j)
+                prev = o1
+            if provides_childs(child):
+                count += self._get_entry(child)[1]
+            else:
+                starts.extend([o1+j for j in _find_all(child.text, text)])
+        count += len(starts)
+        entry = starts, count
+        self._cache[texel] = entry
+        return entry
+
+
+def _find_all(s, text):
+    # Returns the starts of all occurrences of *text* in *s*,
+    # including overlapping ones
+    r = []
+    j = s.find(text)
+    while j >= 0:
+        r.append(j)
+        j = s.find(text, j+1)
+    return r
+
+
+
+def test_00():
+    "finditer"
+    import random
+    from .textmodel import TextModel
+    text = u"".join([random.choice(u"ab\n") for i in range(3000)])
+    model = TextModel(text)
+    model.set_properties(100, 200, bold=True)
+    texel = model.texel
+    for pattern in (u"ab", u"aba", u"a\nb", u"\n\n"):
+        rx = re.compile(re.escape(pattern))
+        expected = [m.span() for m in rx.finditer(text)]
+        for chunk_size in (1, 7, 1000, 65536):
+            found = list(finditer(texel, pattern, chunk_size=chunk_size,
+                                  overlap=3))
+            assert found == expected
+        found = list(finditer(texel, pattern, 10, 2000, chunk_size=100))
+        assert found == [m.span() for m in rx.finditer(text, 10, 2000)]
+        for chunk_size in (1, 7, 1000):
+            found = list(finditer(texel, pattern, reverse=True,
+                                  chunk_size=chunk_size, overlap=1))
+            if pattern in (u"ab", u"a\nb"): # matches can't overlap
+                assert found == expected[::-1]
+            end = len(text)
+            for j1, j2 in found:
+                assert j2 <= end and text[j1:j2] == pattern
+                end = j1
+
+    # matches longer than the overlap
+    rx = re.compile(u"[ab]+")
+    expected = [m.span() for m in rx.finditer(text)]
+    assert list(finditer(texel, rx, chunk_size=10, overlap=2)) == expected
+    assert list(finditer(texel, re.compile(u"b$", re.M), chunk_size=5,
+                         overlap=1)) == \
+        [m.span() for m in re.finditer(u"b$", text, re.M)]
+    assert list(finditer(texel, u"x")) == []
+
+    # strings longer than the overlap
+    assert list(finditer(TextModel(u"xa\nby").texel, u"a\nb", chunk_size=1,
+                         overlap=1)) == [(1, 4)]
+    texel = TextModel(u"aaa").texel
+    for chunk_size in (1, 2, 65536):
+        assert list(finditer(texel, u"aa", reverse=True,
+                             chunk_size=chunk_size)) == [(0, 2)]
+
+    # the last match is found without searching the whole text
+    calls = []
+    class Pattern:
+        def search(self, text, p):
+            calls.append(len(text)-p)
+            return rx.search(text, p)
+    rx = re.compile(u"b")
+    model = TextModel(u"a"*100000+u"b")
+    assert next(finditer(model.texel, Pattern(), reverse=True,
+                         chunk_size=1000)) == (100000, 100001)
+    assert sum(calls) < 2000
+
+
+def test_01():
+    "SearchIndex"
+    import random
+    from .textmodel import TextModel
+    from . import texeltree
+    for nmax in (4, 16):
+        texeltree.set_nmax(nmax)
+        text = u"".join([random.choice(u"ab\n") for i in range(3000)])
+        model = TextModel(text)
+        model.set_properties(100, 200, bold=True)
+        for pattern in (u"ab", u"aba", u"a\nb", u"\n\n", u"abababab"):
+            index = SearchIndex(pattern)
+            rx = re.compile(re.escape(pattern))
+            for k in range(5):
+                text = model.get_text()
+                expected = [m.span() for m in rx.finditer(text)]
+                assert list(index.finditer(model)) == expected
+                assert list(index.finditer(model, reverse=True)) == \
+                    expected[::-1]
+                assert list(index.finditer(model, 10, 2000)) == \
+                    [m.span() for m in rx.finditer(text, 10, 2000)]
+                i = random.randrange(len(model))
+                model.insert_text(i, random.choice([u"ab", u"\n", u"ba"]))
+    texeltree.set_nmax(16)
+    model = TextModel(u"aaaa")
+    assert SearchIndex(u"aa").count(model) == 3
+    assert list(SearchIndex(u"aa").finditer(model)) == [(0, 2), (2, 4)]
@@ -3,7 +3,9 @@
 from . import texeltree
 from .texeltree import G, T, length, grouped, provides_childs, iter_childs, \
     is_root_efficient, is_list_efficient, is_homogeneous, calc_length, \
-    get_pieces, fuse, EMPTYSTYLE, NL, NewLine, style_pool, hash_style
+    get_pieces, fuse, EMPTYSTYLE, NL, NewLine, Style, as_style, \
+    text_leaf, explode, can_merge, merge
+from bisect import bisect_right
 
 
 debug = 0
@@ -31,28 +33,37 @@ class StyleIterator:
 
 
 def create_style(**kwds):
-    global style_pool
-    key = hash_style(kwds)
-    try:
-        return style_pool[key]
-    except KeyError:
-        style_pool[key] = kwds
-        return kwds
+    return as_style(kwds)
 
 
 def updated_style(style, properties):
+    """Returns *style* updated by the dict *properties*.
+
+       The result is memoized in *style*, so that updating many runs
+       by the same properties neither copies nor sorts.
+    """
+    style = as_style(style)
+    if type(properties) is Style:
+        key = properties.key
+    else:
+        key = tuple(properties.items())
+    try:
+        return style.transitions[key]
+    except KeyError:
+        pass
     new = style.copy()
     new.update(properties)
-    return create_style(**new)
+    r = style.transitions[key] = as_style(new)
+    return r
 
 
 def get_style(texel, i):
     if i < 0 or i >= length(texel):
         raise IndexError(i)
     if provides_childs(texel):
-        for i1,i2, child in iter_childs(texel):
-            if i1 <= i < i2:
-                return get_style(child, i-i1)
+        offsets = texel.cumulated[1]
+        k = bisect_right(offsets, i)-1
+        return get_style(texel.childs[k], i-offsets[k])
     return texel.style
 
 
@@ -65,6 +76,50 @@ def fuse_styles(l1, l2):
     return l1+l2
 
 
+def _iter_leaves(texel, i1, i2):
+    # Yields all leaves overlapping i1...i2 together with the length
+    # of the overlap.
+    offsets = texel.cumulated[1]
+    childs = texel.childs
+    k = max(0, bisect_right(offsets, i1)-1)
+    n = len(childs)
+    while k < n and offsets[k] < i2:
+        j1 = offsets[k]
+        j2 = offsets[k+1]
+        if i1 < j2: # intersection
+            child = childs[k]
+            if provides_childs(child):
+                for item in _iter_leaves(child, i1-j1, i2-j1):
+                    yield item
+            else:
+                yield child, min(i2, j2)-max(i1, j1)
+        k += 1
+
+
+def iter_style_runs(texel, i1, i2):
+    """Yields the style runs (n, style) between *i1* and *i2*.
+
+       Neighbouring runs always have different styles. The cost is
+       proportional to the number of leaves in the range plus log(n).
+    """
+    if not provides_childs(texel):
+        if i1 < i2:
+            yield i2-i1, texel.style
+        return
+    n = 0
+    style = None
+    for leaf, m in _iter_leaves(texel, i1, i2):
+        if leaf.style is style:
+            n += m
+        else:
+            if n:
+                yield n, style
+            n = m
+            style = leaf.style
+    if n:
+        yield n, style
+
+
 def get_styles(texel, i1, i2):
     """
     pre:
@@ -74,20 +129,7 @@ def get_styles(texel, i1, i2):
     """
     if i1 == i2:
         return []
-    if provides_childs(texel):
-        j1 = i1
-        j2 = i2
-        styles = []
-        for child in texel.childs:
-            n = length(child)
-            if j1 < n and j2 > 0:
-                new = get_styles(child, j1, min(j2, n))
-                styles = fuse_styles(styles, new)
-            j1 = max(0, j1-n)
-            j2 = max(0, j2-n)
-        return styles
-    return [(i2-i1, texel.style)]
-
+    return list(iter_style_runs(texel, i1, i2))
 
 
 
@@ -102,38 +144,71 @@ def set_styles(texel, i, iterator):
            is_list_efficient(__return__)
            length(texel) == calc_length(__return__)
     """
+    # The restyled leaves are collected in a single list. The
+    # untouched childs left and right of them are kept in one list
+    # per level of the tree.
+    left = []; leaves = []; right = []
+    _set_styles(texel, i, iterator, left, leaves, right)
+    while len(leaves) > texeltree.nmax:
+        leaves = texeltree.groups(leaves)
+    return fuse(*(left+[leaves]+right))
+
+
+def _add_leaf(leaves, texel):
+    if leaves and can_merge(leaves[-1], texel):
+        leaves[-1] = merge(leaves[-1], texel)
+    else:
+        leaves.append(texel)
+
 
+def _set_styles(texel, i, iterator, left, leaves, right):
     if texel.is_group:
-        r1 = []; r2 = []; r3 = []
+        r1 = []; r3 = []
         for j1, j2, child in iter_childs(texel):
             if j2 <= i:
                 r1.append(child)
             elif iterator.finished:
                 r3.append(child)
             else:
-                r2 = fuse(r2, set_styles(child, i-j1, iterator))
-        return fuse(r1, r2, r3)
+                if r1:
+                    left.append(r1)
+                    r1 = []
+                _set_styles(child, i-j1, iterator, left, leaves, right)
+        if r1:
+            left.append(r1)
+        if r3:
+            right.append(r3)
     elif texel.is_single:
         if i >= 1:
-            return [texel]
-        new = texel.set_style(iterator.style)
+            _add_leaf(leaves, texel)
+            return
+        _add_leaf(leaves, texel.set_style(iterator.style))
         iterator.advance(1)
-        return [new]
     elif texel.is_text:
-        r = []
-        text = texel.text
-        if i>0:
-            r.append(T(text[:i], texel.style))
-            text = text[i:]
-
-        while text and not iterator.finished:
-            n = min(len(text), iterator.n)
-            r.append(T(text[:n], iterator.style))
+        style = texel.style
+        n = length(texel)
+        j = max(0, i)
+        if j == 0 and iterator.n >= n:
+            # the whole leaf gets the same style
+            if iterator.style is not style:
+                texel = texel.set_style(iterator.style)
+            _add_leaf(leaves, texel)
             iterator.advance(n)
-            text = text[n:]
-        if text and iterator.finished:
-            r.append(T(text, texel.style))
-        return r
+            return
+        if j:
+            for piece in texel.slice(0, j):
+                _add_leaf(leaves, piece)
+        while j < n and not iterator.finished:
+            m = min(n-j, iterator.n)
+            for piece in texel.slice(j, j+m):
+                if iterator.style is not style:
+                    piece = piece.set_style(iterator.style)
+                _add_leaf(leaves, piece)
+            iterator.advance(m)
+            j += m
+        if j < n:
+            for piece in texel.slice(j, n):
+                _add_leaf(leaves, piece)
     elif texel.is_container:
         r1 = []; r2 = []; r3 = []
         for j1, j2, child in iter_childs(texel):
@@ -143,8 +218,9 @@ def set_styles(texel, i, iterator):
                 r3.append(child)
             else:
                 r2.append(grouped(set_styles(child, i-j1, iterator)))
-        return [texel.set_childs(r1+r2+r3)]
-    assert False
+        leaves.append(texel.set_childs(r1+r2+r3))
+    else:
+        assert False
 
 
 
@@ -156,6 +232,51 @@ def set_properties(texel, i1, i2, properties):
 
 
 
+def apply_spans(styles, i, spans):
+    """Returns the style runs *styles* (starting at index *i*) modified
+       by *spans*.
+
+       *spans* is a list of tuples (i1, i2, properties), sorted and
+       not overlapping. *properties* is either a dict of properties
+       which are updated or a style which replaces the old styles.
+
+       post:
+           style_length(__return__) == style_length(styles)
+    """
+    last = i
+    for k1, k2, properties in spans:
+        if not last <= k1 <= k2:
+            raise ValueError("Spans must be sorted and must not overlap.")
+        last = k2
+    r = []
+    spans = iter(spans)
+    k1, k2, properties = next(spans, (None, None, None))
+    for n, style in styles:
+        i2 = i+n
+        while i < i2:
+            if k1 is None or i < k1:
+                if k1 is None:
+                    m = i2-i
+                else:
+                    m = min(i2, k1)-i
+                new = style
+            else:
+                m = min(i2, k2)-i
+                if type(properties) is Style:
+                    new = properties
+                else:
+                    new = updated_style(style, properties)
+            if r and r[-1][1] is new:
+                r[-1] = (r[-1][0]+m, new)
+            elif m:
+                r.append((m, new))
+            i += m
+            while k1 is not None and i >= k2:
+                k1, k2, properties = next(spans, (None, None, None))
+    return r
+
+
+
 def get_parstyles(texel, i1, i2):
     """
     pre:
@@ -214,6 +335,10 @@ def set_parstyles(texel, i, iterator):
         new = texel.set_parstyle(iterator.style)
         iterator.advance(1)
         return [new]
+    elif texel.is_text:
+        # A leaf containing newlines. We need real NewLine texels to
+        # store paragraph styles.
+        return set_parstyles(grouped(explode(texel)), i, iterator)
     elif texel.is_container:
         r1 = []; r2 = []; r3 = []
         for j1, j2, child in iter_childs(texel):
@@ -325,3 +450,37 @@ def test_12():
 
     print(get_parstyles(g, 0, length(g)))
 
+
+
+def test_13():
+    "Style"
+    s1 = create_style(fontsize=12, bold=True)
+    assert s1 is as_style(dict(bold=True, fontsize=12))
+    assert s1 == dict(bold=True, fontsize=12)
+    assert s1 is not EMPTYSTYLE and create_style() is EMPTYSTYLE
+    try:
+        s1['fontsize'] = 10
+        assert False
+    except TypeError:
+        pass
+    s2 = updated_style(s1, dict(fontsize=10))
+    assert s2 == dict(bold=True, fontsize=10)
+    assert updated_style(s1, dict(fontsize=10)) is s2
+    assert updated_style(s2, s1) is s1
+    assert s1.sid != s2.sid
+
+    from pickle import dumps, loads
+    assert loads(dumps(s2)) is s2
+    t = loads(dumps(T("x", s2)))
+    assert t.style is s2
+
+    sid = create_style(color='blue').sid
+    assert not texeltree.style_pool.get((('color', 'blue'),))
+    assert create_style(color='blue').sid != sid
+
+    # derived styles are released with their last texel
+    t = T("x", updated_style(EMPTYSTYLE, dict(color='green')))
+    assert texeltree.style_pool.get((('color', 'green'),)) is t.style
+    del t
+    assert not texeltree.style_pool.get((('color', 'green'),))
+    assert not EMPTYSTYLE.transitions.get((('color', 'green'),))
@@ -3,10 +3,18 @@
 
 from copy import copy as shallow_copy
 from functools import reduce
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from array import array
+from itertools import count
+from weakref import WeakValueDictionary
+from hashlib import blake2b
+import threading
 
 
 debug = 0
 nmax = 16
+maxtext = 1024
 
 def set_nmax(n):
     """Sets *nmax* to the value *i*.
@@ -19,32 +27,169 @@ def set_nmax(n):
         raise ValueError("nmax must be a multiple of 4.")    
     nmax = n
 
-    
-EMPTYSTYLE = {}
-style_pool = {():EMPTYSTYLE}
+
+def set_maxtext(n):
+    """Sets *maxtext* to the value *n*.
+
+       The value maxtext is the maximum length of text leaves. Longer
+       runs are split into several leaves, so that the cost of an
+       edit does not depend on the length of a run.
+    """
+    global maxtext
+    if n < 1:
+        raise ValueError("maxtext must be positive.")
+    maxtext = n
+
+
+class _EditState(threading.local):
+    # Token of the edit in progress in the current thread, see
+    # transient. Edits in other threads must never see it.
+    edit = None
+
+_state = _EditState()
+
+class transient(object):
+    """Context manager for editing operations.
+
+       Groups which are created inside the with-block belong to the
+       edit and are changed in place by later steps of the same edit,
+       instead of being copied. Outside of the block they are as
+       immutable as all other texels. Only texels which have not yet
+       been handed out may be created in a transient block.
+    """
+    def __enter__(self):
+        self.outer = _state.edit
+        if _state.edit is None:
+            _state.edit = object()
+        return self
+
+    def __exit__(self, *args):
+        _state.edit = self.outer
+
+
+class Style(dict):
+    """An immutable text or paragraph style.
+
+       Styles are interned, i.e. equal styles are the same object (see
+       as_style). Each style has a small integer id *sid* which is
+       never reused and can therefore be used in cache keys.
+    """
+    __slots__ = ('sid', 'key', 'transitions', 'digest', '__weakref__')
+
+    def _immutable(self, *args, **kwds):
+        raise TypeError("styles are immutable")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = \
+        setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __reduce__(self):
+        return as_style, (dict(self),)
+
+
+# Styles are kept as long as they are used somewhere
+style_pool = WeakValueDictionary()
+_sids = count()
 
 def hash_style(style):
+    if type(style) is Style:
+        return style.key
     return tuple(sorted(style.items()))
 
 
 def as_style(d):
-    global style_pool
+    """Returns the interned style with the items of the dict *d*."""
+    if type(d) is Style:
+        return d
     key = hash_style(d)
+    style = style_pool.get(key)
+    if style is None:
+        style = Style(d)
+        style.sid = next(_sids)
+        style.key = key
+        # see styles.updated_style, weak so that derived styles are
+        # released when they are no longer used
+        style.transitions = WeakValueDictionary()
+        style_pool[key] = style
+    return style
+
+
+def _plain_styles(state):
+    # Styles are stored as plain dicts in pickles and other
+    # files. They are interned again by __setstate__.
+    state = state.copy()
+    for name in ('style', 'parstyle'):
+        if name in state:
+            state[name] = dict(state[name])
+    return state
+
+
+EMPTYSTYLE = as_style({})
+
+
+# ---- Tree objects ----
+_slot_cache = {}
+
+def _get_slots(cls):
+    # Returns the names and descriptors of all slots of class *cls*
     try:
-        return style_pool[key]
+        return _slot_cache[cls]
     except KeyError:
-        style_pool[key] = d
-        return d
+        pass
+    slots = []
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get('__slots__', ()):
+            if name not in ('__dict__', '__weakref__'):
+                slots.append((name, klass.__dict__[name]))
+    _slot_cache[cls] = slots
+    return slots
+
+
+def _get_state(texel):
+    # Returns the instance attributes of *texel*, including slots
+    cls = texel.__class__
+    state = {}
+    for name, member in _get_slots(cls):
+        try:
+            state[name] = member.__get__(texel, cls)
+        except AttributeError: # slot not set
+            pass
+    state.update(getattr(texel, '__dict__', ()))
+    return state
 
 
-# ---- Tree objects ----
-class Texel:
+def _set_state(texel, state):
+    for name, value in state.items():
+        setattr(texel, name, value)
+
+
+class Texel(object):
+    # The frequent texels (Text, Lines and Group) use slots. Classes
+    # derived without __slots__ get a __dict__ as usual.
+    __slots__ = ()
     is_single = 0
     is_container = 0
     is_group = 0
     is_text = 0
     is_endmark = 0
     weights = (0, 0, 0) # depth, length, lineno
+    digest = None # cached content hash, see digest()
+
+    def __copy__(self):
+        # Shallow copies don't go through __getstate__ and
+        # __reduce_ex__, which prepare texels for pickling.
+        cls = self.__class__
+        clone = cls.__new__(cls)
+        for name, member in _get_slots(cls):
+            try:
+                member.__set__(clone, member.__get__(self, cls))
+            except AttributeError: # slot not set
+                pass
+        if hasattr(self, '__dict__'):
+            clone.__dict__.update(self.__dict__)
+        return clone
 
 
 class Single(Texel):
@@ -60,19 +205,39 @@ class Single(Texel):
     def set_style(self, style):
         clone = shallow_copy(self)
         clone.style = style
-        return clone
+        return interned(clone)
 
     def __setstate__(self, state):
         self.__dict__ = state.copy()
         self.style = as_style(self.style)
 
+    def __getstate__(self):
+        state = _plain_styles(self.__dict__)
+        state.pop('digest', None)
+        return state
+
+    def __reduce_ex__(self, protocol):
+        if self.__class__ in _internable:
+            # unpickling should return shared instances
+            return _restore_single, (self.__class__, self.__getstate__())
+        return Texel.__reduce_ex__(self, protocol)
+
+
+# Weight tuples of Text leaves are shared. They depend only on the
+# length, which is bounded by maxtext.
+_text_weights = {}
 
 class Text(Texel):
+    __slots__ = ('text', 'style', 'weights')
     is_text = 1
     def __init__(self, text, style=EMPTYSTYLE):
         self.text = text
         self.style = style
-        self.weights = (0, len(text), 0)
+        n = len(text)
+        weights = _text_weights.get(n)
+        if weights is None:
+            weights = _text_weights[n] = (0, n, 0)
+        self.weights = weights
 
     def __repr__(self):
         return "T(%s)" % repr(self.text)
@@ -81,35 +246,219 @@ class Text(Texel):
         clone = shallow_copy(self)
         clone.style = style
         return clone
-    
+
+    def slice(self, i1, i2):
+        """Returns a list of leaves holding the text between *i1* and *i2*.
+
+           All splitting of text leaves goes through slice, so that
+           leaves which don't keep their text in memory can return
+           leaves of their own kind.
+        """
+        return text_leaves(self.text[i1:i2], self.style)
+
+    def __getstate__(self):
+        return _plain_styles(_get_state(self))
+
     def __setstate__(self, state):
-        self.__dict__ = state.copy()
+        _set_state(self, state)
         self.style = as_style(self.style)
 
 T = Text
 
 
+class Lines(Text):
+    """A text leaf containing newlines.
+
+       All newlines in a Lines leaf have the default paragraph
+       style. Plain text documents therefore don't need a NewLine
+       texel for every line. When a paragraph style is set, the leaf
+       is exploded into Text and NewLine texels (see explode).
+    """
+    __slots__ = ('_linestarts',)
+    parstyle = EMPTYSTYLE
+
+    def __init__(self, text, style=EMPTYSTYLE):
+        self.text = text
+        self.style = style
+        self.weights = (0, len(text), text.count('\n'))
+        self._linestarts = None
+
+    def __repr__(self):
+        return "L(%s)" % repr(self.text)
+
+    def get_linestarts(self):
+        """Returns the indices following each newline in the leaf."""
+        if self._linestarts is None:
+            # computed on first use, most leaves are never searched
+            self._linestarts = array('l', accumulate(
+                len(line)+1 for line in self.text.split('\n')[:-1]))
+        return self._linestarts
+
+    def __getstate__(self):
+        state = Text.__getstate__(self)
+        state.pop('_linestarts', None)
+        return state
+
+    def __setstate__(self, state):
+        self._linestarts = None
+        Text.__setstate__(self, state)
+
+
+# Buffers of which less than 1/share_ratio is referenced by living
+# SharedText leaves are no longer shared
+share_ratio = 16
+
+# id(buffer) -> number of characters referenced by living leaves
+_referenced = {}
+_referenced_lock = threading.Lock()
+
+class SharedText(Lines):
+    """A text leaf referencing the characters *start*...*end* of the
+       string *buffer*.
+
+       Long texts are split into shared leaves (see text_leaves), so
+       that splitting, restyling and merging neighbouring pieces don't
+       copy characters. The text is sliced out of the buffer when it
+       is accessed. The buffer is kept alive as long as any of its
+       leaves exists. The leaves count how much of their buffer they
+       reference. Once less than 1/share_ratio of a buffer is
+       referenced, slices are copied and compact copies the leaves.
+    """
+    __slots__ = ('buffer', 'start', 'end')
+
+    def __init__(self, buffer, start, end, style=EMPTYSTYLE):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.style = style
+        self.weights = (0, end-start, buffer.count('\n', start, end))
+        self._linestarts = None
+        key = id(buffer)
+        with _referenced_lock:
+            _referenced[key] = _referenced.get(key, 0)+end-start
+
+    def __del__(self):
+        try:
+            key = id(self.buffer)
+            n = self.end-self.start
+        except AttributeError: # not initialized
+            return
+        with _referenced_lock:
+            n = _referenced[key]-n
+            if n:
+                _referenced[key] = n
+            else:
+                del _referenced[key]
+
+    def __copy__(self):
+        # the copy must be counted as well
+        return SharedText(self.buffer, self.start, self.end, self.style)
+
+    @property
+    def text(self):
+        return self.buffer[self.start:self.end]
+
+    def __repr__(self):
+        return "S(%s)" % repr(self.text)
+
+    def is_mostly_dead(self):
+        """Returns True if less than 1/share_ratio of the buffer is
+           referenced by living leaves."""
+        return _referenced.get(id(self.buffer), 0)*share_ratio < \
+            len(self.buffer)
+
+    def slice(self, i1, i2):
+        if i1 == 0 and i2 == self.end-self.start:
+            return [self]
+        if self.is_mostly_dead():
+            return [text_leaf(self.buffer[self.start+i1:self.start+i2],
+                              self.style)]
+        return [SharedText(self.buffer, self.start+i1, self.start+i2,
+                           self.style)]
+
+    def unshared(self):
+        """Returns a plain copy if the buffer is mostly dead, otherwise
+           the leaf itself."""
+        if self.is_mostly_dead():
+            return text_leaf(self.text, self.style)
+        return self
+
+    def __getstate__(self):
+        # Only the text is stored, not the whole buffer
+        return _plain_styles(dict(text=self.text, style=self.style))
+
+    def __setstate__(self, state):
+        text = state['text']
+        SharedText.__init__(self, text, 0, len(text), as_style(state['style']))
+
+
 class _TexelWithChilds(Texel):
+    # cumulated[windex][k] is the sum of weight windex over all childs
+    # before child k. Only the summed weights (length and lineno) are
+    # stored, entry 0 (depth) is None. Length and lineno are always
+    # the sums of the child weights, since indices are found by
+    # bisecting the prefix sums. Subclasses only define the depth
+    # (see calc_depth).
+    __slots__ = ()
+    owner = None # the edit which created the texel, see transient
+
+    def __getattr__(self, name):
+        # Only called for attributes which are not set. The prefix
+        # sums are missing in restored texels, e.g. after unpickling,
+        # and are computed on first access.
+        if name == 'cumulated':
+            self.compute_weights()
+            return self.cumulated
+        if name in ('owner', 'digest', 'extra'):
+            return None
+        raise AttributeError(name)
+
     def compute_weights(self):
-        if len(self.childs): # for empty groups, we use the default weights
-            w_list = zip(*[child.weights for child in self.childs])
-            self.weights = [f(l) for (l, f) in zip(w_list, self.functions)]
+        childs = self.childs
+        lengths = array('l', [0])
+        linenos = array('l', [0])
+        if len(childs):
+            weights = [child.weights for child in childs]
+            lengths.extend(accumulate([w[1] for w in weights]))
+            linenos.extend(accumulate([w[2] for w in weights]))
+            # The summed weights are the last prefix sums
+            self.weights = (self.calc_depth([w[0] for w in weights]),
+                            lengths[-1], linenos[-1])
+        else:
+            self.weights = (0, 0, 0)
+        self.cumulated = (None, lengths, linenos)
+        self.digest = None
+        self.extra = None
+
+    def __getstate__(self):
+        state = _get_state(self)
+        state.pop('cumulated', None) # recomputed on demand
+        state.pop('owner', None)
+        state.pop('digest', None)
+        state.pop('extra', None)
+        return state
+
+    def __setstate__(self, state):
+        _set_state(self, state)
 
 
 
 class Group(_TexelWithChilds):
+    __slots__ = ('childs', 'weights', 'cumulated', 'owner', 'digest',
+                 'extra', '__weakref__')
     is_group = 1
-    functions = (
-        lambda l:max(l)+1, 
-        sum,               
-        sum)
+
+    def calc_depth(self, depths):
+        return max(depths)+1
 
     def __init__(self, childs):
         # NOTE: childs are assumed to be lists and not to change!
         # Since violations of these requirements can lead to difficult
         # to find bugs, we are making a copy of the list here,
-        # although strictly this should not be necessary.
-        self.childs = list(childs[:])
+        # although strictly this should not be necessary. Internally
+        # _new_group is used for fresh lists.
+        self.childs = list(childs)
+        self.owner = _state.edit
         self.compute_weights()
 
     def __repr__(self):
@@ -117,13 +466,21 @@ class Group(_TexelWithChilds):
 G = Group
 
 
+def _new_group(childs):
+    # Creates a group which takes over the fresh list *childs*
+    group = Group.__new__(Group)
+    group.childs = childs
+    group.owner = _state.edit
+    group.compute_weights()
+    return group
+
+
 
 class Container(_TexelWithChilds):
     is_container = 1
-    functions = (
-        lambda l:0,
-        sum,               
-        sum)
+
+    def calc_depth(self, depths):
+        return 0
         
     def set_childs(self, childs):
         clone = shallow_copy(self)
@@ -151,7 +508,7 @@ class NewLine(Single):
     def set_parstyle(self, style):
         clone = shallow_copy(self)
         clone.parstyle = style
-        return clone
+        return interned(clone)
 
     def __setstate__(self, state):
         self.__dict__ = state.copy()
@@ -173,8 +530,38 @@ class Fraction(Container):
         self.compute_weights()
     
 
-TAB = Tabulator()
-NL = NewLine()
+# Line breaks and tabulators only differ in their styles. Identical
+# ones share a single instance, which is kept in a weak pool.
+_internable = (NewLine, Tabulator)
+_singles = WeakValueDictionary()
+
+def interned(texel):
+    """Returns the shared instance equal to *texel*.
+
+       Only NewLine and Tabulator texels are shared, all other texels
+       (including endmarks) are returned unchanged. Texels must never
+       be modified after interning.
+    """
+    if texel.__class__ not in _internable or texel.is_endmark:
+        return texel
+    # The styles are referenced by the pooled texel, so their ids
+    # stay valid as long as the entry exists.
+    key = texel.__class__, id(texel.style), \
+        id(getattr(texel, 'parstyle', None))
+    shared = _singles.get(key)
+    if shared is None:
+        _singles[key] = shared = texel
+    return shared
+
+
+def _restore_single(cls, state):
+    texel = cls.__new__(cls)
+    texel.__setstate__(state)
+    return interned(texel)
+
+
+TAB = interned(Tabulator())
+NL = interned(NewLine())
 ENDMARK = NewLine()
 ENDMARK.is_endmark = 1
 NULL_TEXEL = T(u'')
@@ -203,6 +590,80 @@ def length(texel):
     return texel.weights[1]
 
 
+# ---- Registered weights ----
+# Additional weights are computed on demand. Groups and containers
+# cache them in *extra*, which maps the weight name to a list [value,
+# prefix sums]. The prefix sums are only computed by the search
+# functions in the weights module. Since an edit creates new groups
+# only along the edited paths, only these are recomputed.
+builtin_weights = dict(depth=0, length=1, lineno=2)
+_weights = {} # name -> (leaf, combine, empty)
+
+def register_weight(name, leaf, combine=sum, empty=0):
+    """Registers an additional weight *name*.
+
+       The weight of a leaf is *leaf(texel)*. The weight of a group
+       or container is *combine* applied to the list of child weights
+       and *empty* if there are no childs. *Combine* must be
+       associative. Weights can't be replaced once registered, since
+       their values are cached in the trees.
+    """
+    if name in builtin_weights or name in _weights:
+        raise ValueError("weight %r is already registered" % name)
+    _weights[name] = leaf, combine, empty
+
+
+def weight(texel, name):
+    """Returns the value of the weight *name* for *texel*."""
+    windex = builtin_weights.get(name)
+    if windex is not None:
+        return texel.weights[windex]
+    leaf, combine, empty = _weights[name]
+    if not provides_childs(texel):
+        return leaf(texel)
+    extra = texel.extra
+    if extra is None:
+        extra = texel.extra = {}
+    entry = extra.get(name)
+    if entry is None:
+        values = [weight(child, name) for child in texel.childs]
+        if values:
+            value = combine(values)
+        else:
+            value = empty
+        entry = extra[name] = [value, None]
+    return entry[0]
+
+
+def cumulated_weight(texel, name):
+    """Returns the prefix sums of weight *name* over the childs of *texel*.
+
+       Only meaningful for weights which are combined by summing.
+    """
+    windex = builtin_weights.get(name)
+    if windex is not None:
+        return texel.cumulated[windex]
+    weight(texel, name)
+    entry = texel.extra[name]
+    if entry[1] is None:
+        sums = [0]
+        sums.extend(accumulate([weight(child, name)
+                                for child in texel.childs]))
+        entry[1] = sums
+    return entry[1]
+
+
+def _utf16_length(texel):
+    # Length in UTF-16 code units, e.g. for editor protocols
+    text = texel.text
+    n = len(text)
+    if text.isascii():
+        return n
+    return n+len([c for c in text if c > u'\uffff'])
+
+register_weight('utf16', _utf16_length)
+
+
 def spans(texel):
     r = []
     mutable = texel.get_mutability()
@@ -304,12 +765,12 @@ def groups(l):
     i1 = 0
     for i in range(n-t):
         i2 = i1+m
-        r.append(Group(l[i1:i2]))
+        r.append(_new_group(l[i1:i2]))
         i1 = i2
 
     for i in range(t):
         i2 = i1+m+1
-        r.append(Group(l[i1:i2]))
+        r.append(_new_group(l[i1:i2]))
         i1 = i2
 
     assert i2 == len(l)
@@ -430,14 +891,13 @@ def insert(texel, i, stuff):
     if not 0 <= i <= length(texel):
         raise IndexError(i)
     if texel.is_group:
-        k = -1
-        for i1, i2, child in iter_childs(texel):
-            k += 1
-            if i1 <= i <= i2:
-                l = insert(child, i-i1, stuff)
-                r1 = texel.childs[:k]
-                r2 = texel.childs[k+1:]
-                return join(r1, l, r2)
+        if texel.childs:
+            offsets = texel.cumulated[1]
+            k = bisect_left(offsets, i, 1)-1 # first child with i <= i2
+            l = insert(texel.childs[k], i-offsets[k], stuff)
+            r1 = texel.childs[:k]
+            r2 = texel.childs[k+1:]
+            return join(r1, l, r2)
     elif texel.is_container:
         mutable = texel.get_mutability()
         k = -1
@@ -500,25 +960,30 @@ def takeout(texel, i1, i2):
     # point we only have G, C or T.
 
     if texel.is_group:
-        r1 = []; r2 = []; r3 = []; r4 = [] # outer rest
+        childs = texel.childs
+        offsets = texel.cumulated[1]
+        # Childs before ka end before i1, childs from kb on start
+        # after i2.
+        ka = bisect_right(offsets, i1, 1)-1
+        kb = bisect_left(offsets, i2, ka)
+        r1 = childs[:ka]; r2 = []; r3 = []; r4 = childs[kb:] # outer rest
         k1 = []; k2 = []; k3 = [] # inner kernel
-        for j1, j2, child in iter_childs(texel):
+        for m in range(ka, kb):
+            j1 = offsets[m]
+            j2 = offsets[m+1]
+            child = childs[m]
             # formal prove of if-conditions in notebook 26.08.2020
             # collecting parts can still be simplified, see same entry
-            if j2 <= i1:
-                r1.append(child)
-            elif j1 < i1:
+            if j1 < i1:
                 r, k = takeout(child, max(i1-j1, 0), min(i2-j1, length(child)))
                 r2.extend(r)
                 k1.extend(k)
             elif j2 <= i2:
                 k2.append(child)
-            elif j1 < i2:
+            else:
                 r, k = takeout(child, max(i1-j1, 0), min(i2-j1, length(child)))
                 r3.extend(r)
                 k3.extend(k)
-            else:
-                r4.append(child)
         # Note that we are returning a list of elements which have
         # been in the content before. So even if texel is only root
         # efficient, the elements muss be element efficient.  Each of
@@ -548,11 +1013,8 @@ def takeout(texel, i1, i2):
         raise IndexError((i1, i2))
 
     elif texel.is_text:
-        r = texel.text[:i1]
-        s = texel.text[i1:i2]
-        t = texel.text[i2:]        
-        style = texel.style
-        return [Text(r+t, style)], [Text(s, style)]
+        rest = fuse(texel.slice(0, i1), texel.slice(i2, length(texel)))
+        return rest, texel.slice(i1, i2)
 
     assert False
 
@@ -596,13 +1058,241 @@ if debug:
 def copy(root, i1, i2):
     """Copy all content of *root* between *i1* and *i2*.
 
+       Unlike takeout, only the copied part is built. Subtrees which
+       are fully inside the interval are reused.
+
        pre:
            isinstance(root, Texel)
 
        post:
            calc_length(__return__) == (i2-i1)
     """
-    return takeout(root, i1, i2)[1]
+    if not (0 <= i1 <= i2 <= length(root)):
+        raise IndexError([i1, i2])
+    return _copy(root, i1, i2)
+
+
+def _copy(texel, i1, i2):
+    if i1 >= i2 or not length(texel):
+        return []
+    if i1 <= 0 and i2 >= length(texel):
+        return strip2list(texel)
+
+    if texel.is_group:
+        childs = texel.childs
+        offsets = texel.cumulated[1]
+        ka = bisect_right(offsets, i1, 1)-1
+        kb = bisect_left(offsets, i2, ka)
+        k1 = []; k2 = []; k3 = []
+        for m in range(ka, kb):
+            j1 = offsets[m]
+            j2 = offsets[m+1]
+            child = childs[m]
+            if j1 < i1:
+                k1 = _copy(child, i1-j1, min(i2-j1, j2-j1))
+            elif j2 <= i2:
+                k2.append(child)
+            else:
+                k3 = _copy(child, 0, i2-j1)
+        return join(k1, k2, k3)
+
+    elif texel.is_container:
+        for j1, j2, child in iter_childs(texel):
+            if  i1 < j2 and j1 < i2: # test of overlap
+                if not (j1 <= i1 and i2 <= j2):
+                    raise IndexError((i1, i2))
+                return _copy(child, i1-j1, i2-j1)
+        raise IndexError((i1, i2))
+
+    elif texel.is_text:
+        return texel.slice(i1, i2)
+
+    assert False
+
+
+def splice(texel, ranges, parts):
+    """Replaces the content in *ranges* by the texels in *parts*.
+
+       *Ranges* is a sorted list of non overlapping tuples (i1, i2).
+       The tree is traversed once from left to right and all subtrees
+       between the ranges are reused, so that the costs grow with the
+       number of ranges but not with their distance. Returns the new
+       texel and a list with the replaced content of each range.
+
+       pre:
+           len(ranges) == len(parts)
+    """
+    splicer = _Splicer(ranges, parts)
+    builder = TreeBuilder()
+    splicer.visit(texel, 0, builder)
+    splicer.close(length(texel), builder)
+    return builder.get_texel(), splicer.olds
+
+
+class _Splicer:
+    def __init__(self, ranges, parts):
+        self.ranges = ranges
+        self.parts = parts
+        self.k = 0 # the current range
+        self.olds = []
+        self.old = TreeBuilder() # collects the content of range k
+
+    def close(self, i, builder):
+        # Completes all ranges which end at or before *i*
+        ranges = self.ranges
+        while self.k < len(ranges) and ranges[self.k][1] <= i:
+            builder.append(self.parts[self.k])
+            self.olds.append(self.old.get_texel())
+            self.old = TreeBuilder()
+            self.k += 1
+
+    def visit(self, texel, j0, builder):
+        n = length(texel)
+        if not n:
+            return
+        self.close(j0, builder)
+        # Subtrees are appended as elements, so that they are reused
+        # and not regrouped.
+        if self.k == len(self.ranges):
+            builder.extend([texel])
+            return
+        j1 = j0+n
+        a, b = self.ranges[self.k]
+        if j1 <= a:
+            builder.extend([texel])
+        elif a <= j0 and j1 <= b:
+            self.old.extend([texel])
+        elif texel.is_group:
+            for child, offset in zip(texel.childs, texel.cumulated[1]):
+                self.visit(child, j0+offset, builder)
+        elif texel.is_container:
+            # As in copy, ranges must not cross the borders of a
+            # container's childs.
+            if a < j0 or b > j1:
+                raise IndexError((a, b))
+            childs = []
+            for child, offset in zip(texel.childs, texel.cumulated[1]):
+                inner = TreeBuilder()
+                self.visit(child, j0+offset, inner)
+                end = j0+offset+length(child)
+                self.close(end, inner)
+                if self.k < len(self.ranges) and \
+                   self.ranges[self.k][0] < end < self.ranges[self.k][1]:
+                    raise IndexError(self.ranges[self.k])
+                childs.append(inner.get_texel())
+            builder.append(texel.set_childs(childs))
+        else:
+            # a leaf which contains range borders
+            points = [j0, j1]
+            ranges = self.ranges
+            for m in range(self.k, len(ranges)):
+                a, b = ranges[m]
+                if a >= j1:
+                    break
+                points.extend([x for x in (a, b) if j0 < x < j1])
+            points = sorted(set(points))
+            for x, y in zip(points, points[1:]):
+                for piece in _copy(texel, x-j0, y-j0):
+                    self.visit(piece, x, builder)
+                    x += length(piece)
+
+
+class TreeBuilder:
+    """Builds an efficient texel tree from left to right.
+
+       Texels are appended one after the other and are packed into
+       groups bottom up. Only the incomplete groups at the right edge
+       of the tree are kept in lists, one list per depth. Appending
+       single leaves therefore costs amortized O(1).
+    """
+    def __init__(self):
+        # levels[d] holds the pending elements of depth d. Elements in
+        # higher levels precede the elements in lower levels.
+        self.levels = []
+        self.length = 0
+
+    def append(self, texel):
+        """Appends *texel*, which must be root efficient."""
+        weights = texel.weights
+        if not weights[1]:
+            return
+        if weights[0] == 0:
+            self.length += weights[1]
+            self._push_leaf(texel)
+        else:
+            self.extend(strip2list(texel))
+
+    def extend(self, l):
+        """Appends the elements of list *l*.
+
+           pre:
+               is_homogeneous(l)
+               is_list_efficient(l)
+        """
+        l = list(filter(length, l))
+        if not l:
+            return
+        if depth(l[0]) == 0:
+            if not self.levels:
+                self.levels.append([])
+            pending = self.levels[0]
+            for texel in l:
+                self.length += texel.weights[1]
+                if pending and can_merge(pending[-1], texel):
+                    pending[-1] = merge(pending[-1], texel)
+                elif len(pending) < nmax:
+                    pending.append(texel)
+                else:
+                    self._push(0, texel)
+            return
+        self.length += calc_length(l)
+        d = depth(l[0])
+        levels = self.levels
+        if [pending for pending in levels[:d] if pending]:
+            # Pending elements of lower or equal depth are fused with
+            # *l*. Elements in higher levels are not touched.
+            low = []
+            for e in reversed(range(min(d+1, len(levels)))):
+                low = fuse(low, levels[e])
+                levels[e] = []
+            l = fuse(low, l)
+            d = depth(l[0])
+        for element in l:
+            self._push(d, element)
+
+    def _push_leaf(self, texel):
+        if not self.levels:
+            self.levels.append([])
+        l = self.levels[0]
+        if l and can_merge(l[-1], texel):
+            l[-1] = merge(l[-1], texel)
+        elif len(l) < nmax:
+            l.append(texel)
+        else:
+            self._push(0, texel)
+
+    def _push(self, d, element):
+        levels = self.levels
+        while len(levels) <= d:
+            levels.append([])
+        l = levels[d]
+        l.append(element)
+        if len(l) > nmax:
+            s = 3*(nmax // 4)
+            group = _new_group(l[:s])
+            del l[:s]
+            self._push(d+1, group)
+
+    def get_list(self):
+        """Returns all appended content as list efficient list."""
+        l = []
+        for pending in reversed(self.levels):
+            l = fuse(l, pending)
+        return l
+
+    def get_texel(self):
+        """Returns all appended content as root efficient texel."""
+        return grouped(self.get_list())
 
 
 def grouped(stuff):
@@ -673,7 +1363,19 @@ def exchange_rightmost(element, new):
     """
     if provides_childs(element):
         l = exchange_rightmost(element.childs[-1], new)
-        return Group(element.childs[:-1]+[l])
+        edit = _state.edit
+        if element.owner is edit and edit is not None:
+            # the group has been created by the current edit
+            element.childs[-1] = l
+            lengths = element.cumulated[1]
+            linenos = element.cumulated[2]
+            lengths[-1] = lengths[-2]+l.weights[1]
+            linenos[-1] = linenos[-2]+l.weights[2]
+            element.weights = (element.weights[0], lengths[-1], linenos[-1])
+            element.digest = None
+            element.extra = None
+            return element
+        return _new_group(element.childs[:-1]+[l])
     return new
 
 
@@ -696,7 +1398,43 @@ def remove_leftmost(element):
 
 def can_merge(texel1, texel2):
     return texel1.is_text and texel2.is_text and \
-           texel1.style is texel2.style
+           texel1.style is texel2.style and \
+           length(texel1)+length(texel2) <= maxtext
+
+
+def text_leaf(text, style=EMPTYSTYLE):
+    """Returns a Text or, if *text* contains newlines, a Lines leaf."""
+    if u'\n' in text:
+        return Lines(text, style)
+    return Text(text, style)
+
+
+def text_leaves(text, style=EMPTYSTYLE):
+    """Returns a list of text leaves holding *text*.
+
+       Texts longer than *maxtext* are split into pieces of nearly
+       equal length. The pieces share *text* as buffer (see
+       SharedText).
+
+       post:
+           calc_length(__return__) == len(text)
+    """
+    n = len(text)
+    if n <= maxtext:
+        return [text_leaf(text, style)]
+    k = (n+maxtext-1) // maxtext # number of pieces
+    m = n // k
+    t = n % k
+    r = []
+    i1 = 0
+    for i in range(k):
+        i2 = i1+m
+        if i < t:
+            i2 += 1
+        r.append(SharedText(text, i1, i2, style))
+        i1 = i2
+    assert i1 == n
+    return r
 
 
 def merge(texel1, texel2):
@@ -711,7 +1449,101 @@ def merge(texel1, texel2):
        post:
            length(__return__) == length(texel1)+length(texel2)
     """
-    return Text(texel1.text+texel2.text, texel1.style)
+    if texel1.__class__ is SharedText and texel2.__class__ is SharedText \
+       and texel1.buffer is texel2.buffer and texel1.end == texel2.start:
+        # neighbouring pieces are joined without copying
+        return SharedText(texel1.buffer, texel1.start, texel2.end,
+                          texel1.style)
+    return text_leaf(texel1.text+texel2.text, texel1.style)
+
+
+def explode(texel):
+    """Returns a list of Text and NewLine texels equivalent to the
+       Lines leaf *texel*.
+
+       post:
+           calc_length(__return__) == length(texel)
+    """
+    style = texel.style
+    parts = texel.text.split(u'\n')
+    r = []
+    for part in parts[:-1]:
+        if part:
+            # lines of lazy leaves can exceed maxtext
+            r.extend(text_leaves(part, style))
+        r.append(interned(NewLine(style)))
+    if parts[-1]:
+        r.extend(text_leaves(parts[-1], style))
+    return r
+
+
+def _collect_d0(texel, l):
+    # Appends all depth-zero elements of *texel* to *l*, merging
+    # neighbours where possible.
+    if texel.is_group:
+        for child in texel.childs:
+            _collect_d0(child, l)
+    elif length(texel):
+        if texel.__class__ is SharedText:
+            texel = texel.unshared()
+        if l and can_merge(l[-1], texel):
+            l[-1] = merge(l[-1], texel)
+        else:
+            l.append(texel)
+
+
+def compact(texel, i1, i2):
+    """Merges fragmented leaves between *i1* and *i2* and regroups them.
+
+       Long editing sessions leave many small leaves which could be
+       merged. The content between *i1* and *i2* is rebuilt as if it
+       was freshly created. Text and styles are not changed.
+
+       pre:
+           is_root_efficient(texel)
+       post:
+           calc_length(__return__) == length(texel)
+           is_list_efficient(__return__)
+    """
+    if not (0 <= i1 <= i2 <= length(texel)):
+        raise IndexError([i1, i2])
+    if i1 == i2:
+        return strip2list(texel)
+    rest, kernel = takeout(texel, i1, i2)
+    l = []
+    for element in kernel:
+        _collect_d0(element, l)
+    while len(l) > nmax:
+        l = groups(l)
+    if not rest:
+        return l
+    return insert(grouped(rest), i1, l)
+
+
+def skip_leaves(texel, i, n):
+    """Returns the index after the next *n* depth-zero elements from *i* on.
+
+       The cost is proportional to *n* and not to the length of the
+       skipped text. Used to split work into slices.
+    """
+    return min(length(texel), i+_skip_leaves(texel, i, n)[0])
+
+
+def _skip_leaves(texel, i, n):
+    # Returns (j, m): the distance j from i after which n elements
+    # have been passed, and the number m of elements still to pass.
+    if not texel.is_group:
+        return length(texel)-i, n-1
+    j = 0
+    for i1, i2, child in iter_childs(texel):
+        if i2 <= i:
+            continue
+        k = max(0, i-i1)
+        d, n = _skip_leaves(child, k, n)
+        j += d
+        if n <= 0:
+            break
+    return j, n
 
 
 def compute_hull(texel, i1, i2, i0=0):
@@ -737,11 +1569,315 @@ def compute_hull(texel, i1, i2, i0=0):
     return i1, i2
 
 
+def iter_text(texel, i1=0, i2=None):
+    """Yields the text between *i1* and *i2* in pieces, one per leaf.
+
+       Neighbouring SharedText leaves of the same buffer are yielded
+       as one piece.
+    """
+    if i2 is None:
+        i2 = length(texel)
+    stack = [(texel, 0)]
+    buffer = None # pending range of shared leaves
+    while stack:
+        texel, j = stack.pop()
+        if provides_childs(texel):
+            offsets = texel.cumulated[1]
+            k1 = max(0, bisect_right(offsets, i1-j)-1)
+            k2 = min(len(texel.childs), bisect_left(offsets, i2-j))
+            childs = texel.childs
+            for k in range(k2-1, k1-1, -1):
+                stack.append((childs[k], j+offsets[k]))
+        elif texel.__class__ is SharedText:
+            a = texel.start+max(0, i1-j)
+            b = texel.start+min(texel.end-texel.start, i2-j)
+            if texel.buffer is buffer and a == end:
+                end = b
+                continue
+            if buffer is not None and start < end:
+                yield buffer[start:end]
+            buffer, start, end = texel.buffer, a, b
+        else:
+            if buffer is not None:
+                if start < end:
+                    yield buffer[start:end]
+                buffer = None
+            text = texel.text
+            if j < i1 or j+len(text) > i2:
+                text = text[max(0, i1-j):i2-j]
+            if text:
+                yield text
+    if buffer is not None and start < end:
+        yield buffer[start:end]
+
+
 def get_text(texel):
+    """Returns the text of *texel*."""
     if texel.is_single or texel.is_text:
         return texel.text
     assert texel.is_group or texel.is_container
-    return u''.join([get_text(x) for x in texel.childs])
+    return u''.join(iter_text(texel))
+
+
+def _feed(h, data):
+    # Adds *data* to the hash object *h*. The length prefix keeps
+    # the boundaries between data items unambiguous.
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    h.update(b'%i:' % len(data))
+    h.update(data)
+
+
+def _style_digest(style):
+    try:
+        return style.digest
+    except AttributeError: # not computed yet
+        pass
+    h = blake2b(digest_size=16)
+    _feed(h, repr(style.key))
+    style.digest = h.digest()
+    return style.digest
+
+
+# Attributes which are covered by the digest of a leaf
+_leaf_state = ('text', 'style', 'parstyle', 'is_endmark', 'weights',
+               '_linestarts')
+_container_state = ('childs', 'weights', 'cumulated', 'owner', 'digest',
+                    'extra', 'style')
+_plain_types = (int, float, str, bytes, bool, type(None))
+
+def _container_data(texel):
+    # Returns the attributes of a container as string, or None if
+    # they can't be represented.
+    items = sorted([item for item in getattr(texel, '__dict__', {}).items()
+                    if item[0] not in _container_state])
+    for name, value in items:
+        if not isinstance(value, _plain_types):
+            return None
+    return repr(items)
+
+_serials = count()
+
+def digest(texel):
+    """Returns a content hash of *texel* as a 16 byte string.
+
+       Equal digests mean that the texels have the same structure,
+       text and styles. The digests of groups and containers are
+       computed from the digests of their childs and are cached, so
+       that comparing subtrees is O(1) once their digests are known.
+       Attributes of containers (e.g. a cell number) are part of the
+       digest if they are numbers or strings. Leaves with data other
+       than text and styles (e.g. images) and containers with other
+       attributes are only equal to themselves.
+    """
+    r = texel.digest
+    if r is not None:
+        return r
+    h = blake2b(digest_size=16)
+    if texel.is_text:
+        # Text, Lines and shared leaves with equal text are equal
+        _feed(h, 'Text')
+    else:
+        _feed(h, texel.__class__.__name__)
+    if texel.is_group or texel.is_container:
+        _feed(h, _style_digest(getattr(texel, 'style', EMPTYSTYLE)))
+        data = _container_data(texel)
+        if data is None:
+            data = str(next(_serials))
+        _feed(h, data)
+        for child in texel.childs:
+            h.update(digest(child))
+        texel.digest = r = h.digest()
+        return r
+    _feed(h, texel.text)
+    _feed(h, _style_digest(texel.style))
+    _feed(h, _style_digest(getattr(texel, 'parstyle', EMPTYSTYLE)))
+    _feed(h, str(texel.is_endmark))
+    if [name for name in getattr(texel, '__dict__', ())
+        if name not in _leaf_state]:
+        # a unique serial stands for the unknown data
+        _feed(h, str(next(_serials)))
+        texel.digest = r = h.digest()
+        return r
+    # Digests of text leaves are not stored, they cost no more than
+    # a copy of the text.
+    return h.digest()
+
+
+def diff(old, new):
+    """Returns the differences between the texel trees *old* and *new*.
+
+       The result is a list of tuples (kind, i1, i2, j1, j2), meaning
+       that old[i1:i2] has become new[j1:j2]. *Kind* is 'text' or, if
+       only styles have changed, 'style'. Subtrees which are shared by
+       both trees are skipped, so comparing two versions of a document
+       costs O(changes*log(n)). Trees which don't share texels are
+       compared leaf by leaf.
+    """
+    r = []
+    _diff([old], [new], 0, 0, r)
+    return r
+
+
+def _diff(l1, l2, i0, j0, r):
+    # Compares the texel lists *l1* and *l2*, which start at *i0* and
+    # *j0* respectively. Texels in both lists serve as anchors.
+    k1 = k2 = 0
+    for k, q in _anchors(l1, l2):
+        texel = l1[k]
+        gap1 = l1[k1:k]
+        gap2 = l2[k2:q]
+        _diff_gap(gap1, gap2, i0, j0, r)
+        i0 += calc_length(gap1)+length(texel)
+        j0 += calc_length(gap2)+length(texel)
+        k1 = k+1
+        k2 = q+1
+    _diff_gap(l1[k1:], l2[k2:], i0, j0, r)
+
+
+def _anchors(l1, l2):
+    # Returns the pairs (k, q) of indices with l1[k] is l2[q]. Only
+    # texels which occur once in each list are used, since interned
+    # singles and shared subtrees can repeat. Of these pairs the
+    # longest increasing sequence is returned.
+    counts = {}
+    for texel in l1:
+        key = id(texel)
+        counts[key] = counts.get(key, 0)+1
+    ids = {}
+    for q, texel in enumerate(l2):
+        key = id(texel)
+        if key in ids:
+            ids[key] = None
+        elif counts.get(key) == 1 and not texel.is_single:
+            ids[key] = q
+    pairs = []
+    for k, texel in enumerate(l1):
+        q = ids.get(id(texel))
+        if q is not None:
+            pairs.append((k, q))
+    # patience sorting: tails[m] is the index of the pair which ends
+    # the best increasing sequence of length m+1
+    tails = []
+    values = []
+    prev = [None]*len(pairs)
+    for m, (k, q) in enumerate(pairs):
+        n = bisect_left(values, q)
+        if n:
+            prev[m] = tails[n-1]
+        if n == len(tails):
+            tails.append(m)
+            values.append(q)
+        else:
+            tails[n] = m
+            values[n] = q
+    r = []
+    m = tails[-1] if tails else None
+    while m is not None:
+        r.append(pairs[m])
+        m = prev[m]
+    r.reverse()
+    return r
+
+
+def _diff_gap(l1, l2, i0, j0, r):
+    # Empty texels, e.g. the root of an empty document, have depth 0
+    # but are no leaves.
+    l1 = [texel for texel in l1 if length(texel)]
+    l2 = [texel for texel in l2 if length(texel)]
+    if not l1 and not l2:
+        return
+    d = max([depth(texel) for texel in l1+l2])
+    if d > 0 or [texel for texel in l1+l2 if texel.is_container]:
+        # expand the deepest texels and look for anchors again
+        _diff(_expand(l1, d), _expand(l2, d), i0, j0, r)
+    else:
+        _diff_leaves(l1, l2, i0, j0, r)
+
+
+def _expand(l, d):
+    r = []
+    for texel in l:
+        if provides_childs(texel) and depth(texel) == d:
+            r.extend(texel.childs)
+        else:
+            r.append(texel)
+    return r
+
+
+def _style_runs(leaves):
+    # Returns a list of tuples (end, (style, parstyle))
+    runs = []
+    i = 0
+    for leaf in leaves:
+        i += length(leaf)
+        runs.append((i, (leaf.style, getattr(leaf, 'parstyle', EMPTYSTYLE))))
+    return runs
+
+
+def _style_hull(runs1, o1, runs2, o2, n):
+    # Returns the first and the last index in 0...n where the styles
+    # in runs1 (from o1 on) and runs2 (from o2 on) differ, or None.
+    k1 = bisect_right(runs1, (o1, ))
+    k2 = bisect_right(runs2, (o2, ))
+    i = 0
+    first = last = None
+    while i < n:
+        e1, key1 = runs1[k1]
+        e2, key2 = runs2[k2]
+        e = min(e1-o1, e2-o2, n)
+        if key1 != key2:
+            if first is None:
+                first = i
+            last = e
+        if e1-o1 == e:
+            k1 += 1
+        if e2-o2 == e:
+            k2 += 1
+        i = e
+    if first is None:
+        return None
+    return first, last
+
+
+def _common_prefix(s1, s2):
+    # Returns the length of the common prefix of *s1* and *s2*
+    lo = 0
+    hi = min(len(s1), len(s2))
+    while lo < hi:
+        m = (lo+hi+1) // 2
+        if s1[lo:m] == s2[lo:m]:
+            lo = m
+        else:
+            hi = m-1
+    return lo
+
+
+def _diff_leaves(l1, l2, i0, j0, r):
+    s1 = u''.join([leaf.text for leaf in l1])
+    s2 = u''.join([leaf.text for leaf in l2])
+    n1 = len(s1)
+    n2 = len(s2)
+    p = _common_prefix(s1, s2)
+    m = min(n1, n2)-p
+    s = _common_prefix(s1[::-1][:m], s2[::-1][:m])
+    runs1 = _style_runs(l1)
+    runs2 = _style_runs(l2)
+    if p+s == n1 == n2: # same text
+        hull = _style_hull(runs1, 0, runs2, 0, n1)
+        if hull is not None:
+            a, b = hull
+            r.append(('style', i0+a, i0+b, j0+a, j0+b))
+        return
+    hull = _style_hull(runs1, 0, runs2, 0, p)
+    if hull is not None:
+        a, b = hull
+        r.append(('style', i0+a, i0+b, j0+a, j0+b))
+    r.append(('text', i0+p, i0+n1-s, j0+p, j0+n2-s))
+    hull = _style_hull(runs1, n1-s, runs2, n2-s, s)
+    if hull is not None:
+        a, b = hull
+        r.append(('style', i0+n1-s+a, i0+n1-s+b, j0+n2-s+a, j0+n2-s+b))
 
 
 # ---- Debug Tools ---
@@ -1106,3 +2242,496 @@ def test_11():
     assert nl2.parstyle == dict(base='h2')
 
 
+def test_12():
+    "maxtext"
+    set_nmax(4)
+    set_maxtext(10)
+    try:
+        l = text_leaves("0123456789"*5+"x")
+        assert [length(x) for x in l] == [9, 9, 9, 8, 8, 8]
+        assert get_text(grouped(l)) == "0123456789"*5+"x"
+
+        # leaves never grow beyond maxtext
+        texel = Group([])
+        for i in range(100):
+            texel = grouped(insert(texel, i//2, [Text(str(i%10))]))
+            for j1, j2, leaf in iter_leaves(texel):
+                assert j2-j1 <= 10
+        assert is_root_efficient(texel)
+
+        # oversized leaves are split on first edit
+        r, k = takeout(Text("x"*100), 50, 51)
+        assert max([length(x) for x in r]) <= 10
+        assert calc_length(r) == 99
+        assert is_list_efficient(r)
+    finally:
+        set_maxtext(1024)
+
+
+def test_13():
+    "compact"
+    set_nmax(4)
+    s1 = as_style(dict(color='red'))
+    texel = Group([])
+    for i in range(200):
+        texel = grouped(insert(texel, i, [Text("x")]))
+    # fragment the text by inserting and removing styled pieces
+    for i in range(0, 200, 3):
+        texel = grouped(insert(texel, i, [Text("y", s1)]))
+        texel = grouped(takeout(texel, i, i+1)[0])
+    n = len(get_pieces(texel))
+    old = get_text(texel)
+    assert n > 1
+
+    new = grouped(compact(texel, 0, length(texel)))
+    assert get_text(new) == old
+    assert get_pieces(new) == [old]
+    assert is_root_efficient(new)
+
+    part = grouped(compact(texel, 10, 100))
+    assert get_text(part) == old
+    assert len(get_pieces(part)) < n
+    assert is_root_efficient(part)
+
+    assert skip_leaves(part, 0, 1000) == length(part)
+    i = 0
+    k = 0
+    while i < length(texel):
+        j = skip_leaves(texel, i, 10)
+        texel = grouped(compact(texel, i, j))
+        i = j
+        k += 1
+    assert get_pieces(texel) == [old]
+    assert k > 1
+
+
+def test_14():
+    "cumulated weights"
+    set_nmax(4)
+    g = G([T("01"), NL, T("234"), NL, T("5")])
+    assert list(g.cumulated[1]) == [0, 2, 3, 6, 7, 8]
+    assert list(g.cumulated[2]) == [0, 0, 1, 1, 2, 2]
+    assert list(G([]).cumulated[1]) == [0]
+
+    from pickle import dumps, loads
+    g_ = loads(dumps(g))
+    assert list(g_.cumulated[1]) == list(g.cumulated[1])
+    del g_.cumulated # e.g. an old pickle
+    assert list(g_.cumulated[2]) == list(g.cumulated[2])
+
+
+def test_15():
+    "TreeBuilder"
+    set_nmax(4)
+    s1 = as_style(dict(color='red'))
+    builder = TreeBuilder()
+    text = ''
+    for i in range(500):
+        c = str(i%10)
+        if i % 7:
+            builder.append(Text(c))
+        else:
+            builder.append(Text(c, s1))
+        text += c
+        if i % 50 == 0:
+            tmp = grouped([Text("abc"), NL, Text("def")]*10)
+            builder.append(tmp)
+            text += get_text(tmp)
+        assert builder.length == len(text)
+    texel = builder.get_texel()
+    assert get_text(texel) == text
+    assert is_root_efficient(texel)
+    assert is_clean(strip2list(texel))
+
+    builder = TreeBuilder()
+    for i in range(100):
+        builder.append(Text("x"))
+    assert get_pieces(builder.get_texel()) == ["x"*100]
+    assert TreeBuilder().get_list() == []
+
+
+def test_16():
+    "Lines"
+    from .weights import find_weight, get_weight
+    text = "abc\ndef\n\nxyz"
+    texel = grouped(text_leaves(text))
+    assert isinstance(texel, Lines)
+    assert texel.weights == (0, 12, 3)
+    assert [find_weight(texel, w, 2) for w in range(4)] == [0, 4, 8, 9]
+    for i in range(len(text)+1):
+        assert get_weight(texel, 2, i) == text[:i].count('\n')
+    assert is_clean(explode(texel))
+    assert get_text(grouped(explode(texel))) == text
+    assert grouped(text_leaves("abc")).__class__ is Text
+
+    # merging and splitting chooses the leaf type
+    l = fuse([Text("abc")], [Lines("\ndef")])
+    assert len(l) == 1 and isinstance(l[0], Lines)
+    rest, kernel = takeout(l[0], 0, 3)
+    assert isinstance(kernel[0], Text) and isinstance(rest[0], Lines)
+
+    from pickle import dumps, loads
+    texel.get_linestarts()
+    texel2 = loads(dumps(texel))
+    assert texel2._linestarts is None
+    assert find_weight(texel2, 2, 2) == 8
+
+
+def test_17():
+    "interned singles"
+    s1 = as_style(dict(color='red'))
+    nl1 = NL.set_style(s1)
+    assert nl1 is NL.set_style(s1) is interned(NewLine(s1))
+    assert nl1 is not NL
+    assert nl1.set_parstyle(EMPTYSTYLE) is nl1
+    assert interned(NewLine()) is NL
+    assert TAB.set_style(s1) is interned(Tabulator(s1))
+    assert ENDMARK.set_style(s1) is not ENDMARK.set_style(s1)
+
+    from pickle import dumps, loads
+    l = loads(dumps([NL, TAB, nl1, ENDMARK]))
+    assert l[:3] == [NL, TAB, nl1]
+    assert l[3].is_endmark
+    assert l[3] is not ENDMARK
+
+    nl2 = nl1.set_parstyle(as_style(dict(base='h1')))
+    key = NewLine, id(s1), id(nl2.parstyle)
+    assert key in _singles
+    del nl2
+    assert not key in _singles
+
+
+def test_18():
+    "iter_text"
+    texel = grouped([Text("01234"), NL, Group([Text("567"), TAB, Text("")]),
+                     Text("89")])
+    text = get_text(texel)
+    assert text == "01234\n567\t89"
+    assert list(iter_text(texel)) == ["01234", "\n", "567", "\t", "89"]
+    for i1 in range(len(text)+1):
+        for i2 in range(i1, len(text)+1):
+            assert u''.join(iter_text(texel, i1, i2)) == text[i1:i2]
+    assert list(iter_text(texel, 3, 7)) == ["34", "\n", "5"]
+
+
+def test_19():
+    "copy"
+    import random
+    for nmax in (4, 16):
+        set_nmax(nmax)
+        texel = grouped([Text(c) if c != '\n' else NL
+                         for c in "0123456789\nabcdef"*20])
+        text = get_text(texel)
+        for i in range(100):
+            i1 = random.randrange(len(text)+1)
+            i2 = random.randrange(i1, len(text)+1)
+            l = copy(texel, i1, i2)
+            assert get_text(grouped(l)) == text[i1:i2]
+            assert is_list_efficient(l)
+            assert is_homogeneous(l)
+    set_nmax(16)
+    # Texels inside the interval are shared
+    g1 = Group([Text("abc"), Text("def")])
+    g2 = Group([Text("ghi"), Text("jkl")])
+    l = copy(Group([g1, g2]), 1, 12)
+    assert get_pieces(l) == ['bc', 'def', 'ghi', 'jkl']
+    assert l[0].childs[2] is g2.childs[0]
+    try:
+        copy(g1, 2, 7)
+        assert False
+    except IndexError:
+        pass
+
+
+def test_20():
+    "transient"
+    with transient():
+        g = grouped([Text("a"), NL, Text("c")])
+        assert exchange_rightmost(g, Text("x")) is g
+        with transient(): # nested blocks belong to the same edit
+            assert exchange_rightmost(g, Text("y")) is g
+    assert get_text(g) == "a\ny"
+    assert g.weights == (1, 3, 1)
+    assert list(g.cumulated[1]) == [0, 1, 2, 3]
+
+    # outside of the edit, g is immutable
+    g2 = exchange_rightmost(g, Text("zz"))
+    assert g2 is not g
+    assert get_text(g) == "a\ny"
+    assert get_text(g2) == "a\nzz"
+    with transient():
+        assert exchange_rightmost(g, Text("zz")) is not g
+
+    from pickle import dumps, loads
+    assert loads(dumps(g)).owner is None
+
+
+def test_21():
+    "diff"
+    import random
+    from .textmodel import TextModel
+    def check(old, new):
+        changes = diff(old, new)
+        t1 = get_text(old)
+        t2 = get_text(new)
+        i = j = 0
+        for kind, i1, i2, j1, j2 in changes:
+            assert i <= i1 and j <= j1
+            assert t1[i:i1] == t2[j:j1]
+            if kind == 'style':
+                assert i2-i1 == j2-j1
+                assert t1[i1:i2] == t2[j1:j2]
+            i, j = i2, j2
+        assert t1[i:] == t2[j:]
+        return changes
+
+    model = TextModel(u"0123456789\n"*1000)
+    old = model.texel
+    model.insert_text(5000, u"abc")
+    assert check(old, model.texel) == [('text', 5000, 5000, 5000, 5003)]
+    model.remove(20, 30)
+    model.set_properties(9000, 9005, bold=True)
+    changes = check(old, model.texel)
+    assert changes == [('text', 20, 30, 20, 20),
+                       ('text', 5000, 5000, 4990, 4993),
+                       ('style', 9007, 9012, 9000, 9005)]
+    assert diff(old, old) == []
+
+    # trees without shared texels
+    old = TextModel(u"Hello world").texel
+    new = TextModel(u"Hello, world").texel
+    assert diff(old, new) == [('text', 5, 5, 5, 6)]
+
+    # empty trees
+    empty = TextModel(u"").texel
+    xy = TextModel(u"xy").texel
+    assert diff(empty, xy) == [('text', 0, 0, 0, 2)]
+    assert diff(xy, empty) == [('text', 0, 2, 0, 0)]
+    assert diff(empty, TextModel(u"").texel) == []
+
+    # repeated singles and shared subtrees are no anchors
+    line = Text(u"line")
+    old = G([line, NL, line, NL, Text(u"abc"), NL])
+    new = G([Text(u"liXne"), NL, line, NL, old.childs[4], NL])
+    assert diff(old, new) == [('text', 2, 2, 2, 3)]
+    model = TextModel(u"line\n"*6)
+    for i in range(6):
+        model.set_parproperties(5*i, 5*i+5, number=i)
+    old = model.texel
+    model.insert_text(4, u"X")
+    assert diff(old, model.texel) == [('text', 4, 4, 4, 5)]
+    model = TextModel(u"aaa\nbbb\nccc")
+    old = model.texel
+    model.insert_text(5, u"X")
+    assert diff(old, model.texel) == [('text', 5, 5, 5, 6)]
+
+    for k in range(20):
+        model = TextModel(u"0123456789\n"*50)
+        old = model.texel
+        for m in range(3):
+            i1 = random.randrange(len(model)+1)
+            i2 = random.randrange(i1, min(len(model), i1+20)+1)
+            choice = random.randrange(3)
+            if choice == 0:
+                model.insert_text(i1, u"xy\nz")
+            elif choice == 1:
+                model.remove(i1, i2)
+            else:
+                model.set_properties(i1, i2, bold=True)
+        check(old, model.texel)
+
+
+def test_22():
+    "digest"
+    from .textmodel import TextModel
+    from pickle import dumps, loads
+    model1 = TextModel(u"0123456789\n"*1000)
+    model2 = TextModel(u"0123456789\n"*1000)
+    assert model1.texel is not model2.texel
+    assert digest(model1.texel) == digest(model2.texel)
+    assert digest(loads(dumps(model1.texel))) == digest(model1.texel)
+    model2.set_properties(5000, 5001, bold=True)
+    assert digest(model1.texel) != digest(model2.texel)
+    model2.set_properties(5000, 5001, bold=False)
+    model2.set_properties(5000, 5001, bold=True)
+    model1.set_properties(5000, 5001, bold=True)
+    assert digest(model1.texel) == digest(model2.texel)
+    model1.insert_text(5000, u"x")
+    assert digest(model1.texel) != digest(model2.texel)
+    model2.insert_text(5000, u"x")
+    assert digest(model1.texel) == digest(model2.texel)
+
+    # texels with unknown data
+    class Image(Single):
+        def __init__(self, data):
+            self.data = data
+    image = Image('abc')
+    assert digest(image) == digest(image)
+    assert digest(image) != digest(Image('abc'))
+    assert digest(ENDMARK) == digest(ENDMARK.set_style(EMPTYSTYLE))
+    assert digest(ENDMARK) != digest(NL)
+    assert 'digest' not in image.__getstate__()
+
+    # attributes of containers
+    class Cell(Container):
+        def __init__(self, text, number=0, data=None):
+            self.number = number
+            if data is not None:
+                self.data = data
+            self.childs = [text]
+            self.compute_weights()
+    text = T(u"abc")
+    assert digest(Cell(text, 1)) == digest(Cell(text, 1))
+    assert digest(Cell(text, 1)) != digest(Cell(text, 2))
+    assert digest(Cell(text, 1, [])) != digest(Cell(text, 1, []))
+
+    # in place changes of groups
+    with transient():
+        g = _new_group([T(u"a"), T(u"b")])
+        d = digest(g)
+        assert exchange_rightmost(g, T(u"c")) is g
+        assert digest(g) != d
+        assert digest(g) == digest(Group([T(u"a"), T(u"c")]))
+
+
+def test_23():
+    "registered weights"
+    from .textmodel import TextModel
+    from .weights import find_weight, get_weight
+    text = u"abc\U0001F600def\n"*100
+    model = TextModel(text)
+    model.set_properties(10, 20, bold=True)
+    model.insert_text(500, u"\U0001F600")
+    text = model.get_text()
+    texel = model.texel
+    utf16 = len(text.encode('utf-16-le'))//2
+    assert weight(texel, 'utf16') == utf16
+    assert weight(texel, 'length') == len(text)
+    for i in (0, 1, 3, 4, 5, 500, 501, 502, len(text)):
+        w = len(text[:i].encode('utf-16-le'))//2
+        assert get_weight(texel, 'utf16', i) == w
+        assert find_weight(texel, w, 'utf16') == i
+    assert get_weight(texel, 'lineno', 8) == 1
+    assert find_weight(texel, 1, 'lineno') == 8
+
+    # cached values are recomputed after changes
+    model.insert_text(0, u"\U0001F600")
+    assert weight(model.texel, 'utf16') == utf16+2
+
+    try:
+        register_weight('utf16', len)
+        assert False
+    except ValueError:
+        pass
+
+    register_weight('test_23', lambda texel: 1, combine=max)
+    try:
+        assert weight(model.texel, 'test_23') == 1
+        assert weight(G([]), 'test_23') == 0
+    finally:
+        del _weights['test_23']
+
+
+def test_24():
+    "splice"
+    import random
+    from .textmodel import TextModel
+    for nmax in (4, 16):
+        set_nmax(nmax)
+        text = u"0123456789\n"*300
+        model = TextModel(text)
+        model.set_properties(100, 200, bold=True)
+        texel = model.texel
+        for k in range(20):
+            ranges = []
+            i = 0
+            while True:
+                i1 = i+random.randrange(0, 200)
+                i2 = i1+random.randrange(0, 20)
+                if i2 > len(text):
+                    break
+                ranges.append((i1, i2))
+                i = i2
+            parts = [Text(u"x"*random.randrange(3)) for r in ranges]
+            new, olds = splice(texel, ranges, parts)
+            assert is_root_efficient(new)
+            expected = []
+            i = 0
+            for (i1, i2), part in zip(ranges, parts):
+                expected.append(text[i:i1]+part.text)
+                i = i2
+            assert get_text(new) == u''.join(expected)+text[i:]
+            assert [get_text(old) for old in olds] == \
+                [text[i1:i2] for (i1, i2) in ranges]
+    set_nmax(16)
+
+    # ranges in containers
+    c = Fraction(Text(u"abc"), Text(u"def"))
+    texel = G([Text(u"0123"), c, Text(u"456")])
+    new, olds = splice(texel, [(5, 6), (9, 9)], [Text(u"x"), Text(u"y")])
+    assert get_text(new) == u"0123\txbc\tydef\t456"
+    assert [get_text(old) for old in olds] == [u"a", u""]
+    assert new.childs[1].__class__ is Fraction
+    for ranges in ([(3, 6)], [(6, 10)]):
+        try:
+            splice(texel, ranges, [Text(u"x")])
+            assert False
+        except IndexError:
+            pass
+
+
+def test_25():
+    "SharedText"
+    import pickle
+    text = u"0123456789\nabcdefghij"*60
+    leaves = text_leaves(text)
+    assert len(leaves) > 1
+    for leaf in leaves:
+        assert leaf.__class__ is SharedText and leaf.buffer is text
+    texel = grouped(leaves)
+    assert get_text(texel) is text
+    assert length(texel) == len(text)
+    assert texel.weights[2] == text.count(u'\n')
+
+    # splitting, copying and restyling keep the buffer
+    rest, kernel = takeout(texel, 100, 1000)
+    assert get_text(grouped(rest)) == text[:100]+text[1000:]
+    assert get_text(grouped(kernel)) == text[100:1000]
+    style = as_style(dict(bold=True))
+    for leaf in [leaf.set_style(style) for leaf in kernel]:
+        assert leaf.__class__ is SharedText and leaf.buffer is text
+    # only pieces which are not neighbours are copied when merged
+    assert [leaf.__class__ for leaf in rest] == [Lines]
+
+    # neighbouring pieces are merged without copying
+    a, b = leaves[0].slice(0, 100)[0], leaves[0].slice(100, 200)[0]
+    ab = merge(a, b)
+    assert ab.__class__ is SharedText and ab.text == text[:200]
+    assert merge(b, a).text == text[100:200]+text[:100]
+    assert digest(ab) == digest(Lines(text[:200]))
+
+    # compacting a fresh paste keeps it shared
+    big = u"0123456789"*10000
+    leaves = text_leaves(big)
+    l = [leaf for i1, i2, leaf in
+         iter_leaves(grouped(compact(grouped(leaves), 0, len(big))))]
+    assert [leaf.__class__ for leaf in l] == [SharedText]*len(leaves)
+    assert l[0].buffer is big
+    assert leaves[0].slice(0, 100)[0].__class__ is SharedText
+
+    # small pieces don't keep large buffers alive
+    rest, kernel = takeout(grouped(leaves), 10, len(big)-10)
+    assert [leaf.__class__ for leaf in rest] == [Text]
+    n = 2*length(leaves[0])
+    small = grouped(leaves[:2])
+    del leaves, l, rest, kernel
+    assert small.childs[0].slice(0, 100)[0].__class__ is Text
+    l = compact(small, 0, n)
+    assert [leaf.__class__ for leaf in l] == [Text, Text]
+    assert get_text(grouped(l)) == big[:n]
+    del small, l
+    assert id(big) not in _referenced
+    leaves = text_leaves(text)
+    leaf = pickle.loads(pickle.dumps(leaves[1]))
+    assert leaf.text == leaves[1].text and leaf.buffer == leaf.text
+    assert leaf.weights == leaves[1].weights
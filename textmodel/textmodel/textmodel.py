@@ -4,13 +4,21 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from .texeltree import Text, Group, NewLine, Tabulator, insert, takeout, \
+    compact, skip_leaves, TreeBuilder, Texel, as_style, \
     ENDMARK, is_homogeneous, provides_childs, grouped, length, iter_childs, depth, \
-    is_list_efficient, is_root_efficient, strip2list, EMPTYSTYLE
+    is_list_efficient, is_root_efficient, strip2list, text_leaves, fuse, \
+    get_pieces, interned, EMPTYSTYLE, transient
 from .styles import updated_style, create_style, get_styles, set_styles, \
     get_style, set_properties, get_parstyles, set_parstyles, set_parproperties, \
-    StyleIterator
+    StyleIterator, apply_spans
 from .weights import find_weight, get_weight, NotFound
+from .search import finditer
 from .modelbase import Model
+from .properties import overridable_property
+from . import texeltree
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
 import re
 from six.moves import range
 
@@ -21,23 +29,116 @@ debug = 0
 
 def _get_texel(texel, i):
     if provides_childs(texel):
-        for i1, i2, child in iter_childs(texel):
-            if i1 <= i < i2:
-                return _get_texel(child, i-i1)
+        if 0 <= i < length(texel):
+            offsets = texel.cumulated[1]
+            k = bisect_right(offsets, i)-1
+            return _get_texel(texel.childs[k], i-offsets[k])
     else:
-        if i != 0:
+        if i and not 0 < i < length(texel):
             raise IndexError(i)
     return texel
 
-def _get_text(texel, i1, i2):
-    r = []
-    if provides_childs(texel):
-        for j1, j2, child in iter_childs(texel):
-            if i1 < j2 and j1 < i2: # intersection
-                r.append(_get_text(child, i1-j1, i2-j1))
-        return u''.join(r)
-    text = texel.text
-    return text[max(0, i1):min(i2, len(text))]
+def _chunked(pieces, size):
+    # Joins or splits *pieces* into strings of length *size*. Only the
+    # last string can be shorter.
+    buf = []
+    n = 0
+    for piece in pieces:
+        i = 0
+        while i < len(piece):
+            part = piece[i:i+size-n]
+            buf.append(part)
+            n += len(part)
+            i += len(part)
+            if n == size:
+                yield u''.join(buf)
+                buf = []
+                n = 0
+    if buf:
+        yield u''.join(buf)
+
+
+def _first_newline(texel):
+    # Returns the index of the first newline in *texel* and the leaf
+    # containing it.
+    i = 0
+    while provides_childs(texel):
+        sums = texel.cumulated[2]
+        k = bisect_left(sums, 1)-1
+        i += texel.cumulated[1][k]
+        texel = texel.childs[k]
+    if texel.is_text:
+        i += texel.get_linestarts()[0]-1
+    return i, texel
+
+
+def _line_start(path):
+    # Returns the index after the last newline left of *path*. Path
+    # entries are tuples (group, start, row, k).
+    for group, start, row, k in reversed(path):
+        sums = group.cumulated[2]
+        if sums[k]:
+            j = bisect_left(sums, sums[k])-1 # child with the newline
+            child = group.childs[j]
+            return start+group.cumulated[1][j]+\
+                find_weight(child, child.weights[2], 2)
+    return 0
+
+
+def _line_end(path):
+    # Returns the index of the first newline right of *path* and the
+    # leaf containing it.
+    for group, start, row, k in reversed(path):
+        sums = group.cumulated[2]
+        if sums[-1] > sums[k+1]:
+            j = bisect_right(sums, sums[k+1])-1 # child with the newline
+            i, leaf = _first_newline(group.childs[j])
+            return start+group.cumulated[1][j]+i, leaf
+    raise IndexError() # can not happen as long as there is an ENDMARK
+
+
+Location = namedtuple('Location', ['row', 'col', 'linestart', 'lineend',
+                                   'texel', 'offset', 'style', 'parstyle'])
+
+
+class _Changes:
+    # Collects the signals emitted during a transaction. The changed
+    # range a...b is kept in current indices, delta is the change in
+    # length.
+    a = b = None
+    delta = 0
+
+    def record(self, message, args):
+        if message == 'inserted':
+            i, n = args
+            self.replaced(i, i, n)
+        elif message == 'removed':
+            i, text = args
+            self.replaced(i, i+len(text), 0)
+        elif message == 'properties_changed':
+            i1, i2 = args
+            self.replaced(i1, i2, i2-i1)
+        elif message == 'replaced':
+            self.replaced(*args)
+        else:
+            return False
+        return True
+
+    def replaced(self, i1, i2, n):
+        if self.a is None:
+            self.a = i1
+            self.b = i1+n
+        else:
+            if self.b >= i2:
+                self.b += n-(i2-i1)
+            else:
+                self.b = i1+n
+            self.a = min(self.a, i1)
+        self.delta += n-(i2-i1)
+
+    def get_signal(self):
+        # Returns the arguments of the "replaced" signal
+        return self.a, self.b-self.delta, self.b-self.a
 
 
 def dump_range(texel, i1, i2, i0=0, indent=0):
@@ -56,13 +157,17 @@ def dump_range(texel, i1, i2, i0=0, indent=0):
                 skip = True # skip output of more '...'
 
 
-_split = re.compile(r"([\t\n])", re.MULTILINE).split
+# Newlines are kept in the text leaves (see texeltree.Lines), only
+# tabulators need texels of their own.
+_split = re.compile(r"(\t)").split
 class TextModel(Model):
     """A data type for storing and manipulating styled text. Changes to
     the data are notified to views by emitting the following signals:
     - "inserted" (arguments: i, length)
     - "removed" (arguments: i, removed data)
     - "properties changed" (arguments: i1, i2)
+    - "replaced" (arguments: i1, i2, n), i.e. the data between i1 and
+      i2 has been replaced by n new elements
 
     """
     defaultstyle = create_style()
@@ -78,23 +183,120 @@ class TextModel(Model):
         l = []
         text = text.replace('\r', '')
         for part in _split(text):
-            if part == '\n':
-                l.append(NewLine(style))
-            elif part == '\t':
-                l.append(Tabulator(style))
+            if part == '\t':
+                l.append(interned(Tabulator(style)))
             elif len(part):
-                l.append(Text(part, style))
+                l.extend(text_leaves(part, style))
         self.texel = grouped(l)
 
+    @classmethod
+    def from_file(cls, filename, encoding='utf-8', **properties):
+        """Creates a textmodel for the file *filename*.
+
+           The file is memory mapped and only decoded where the text
+           is accessed (see lazytext.map_file). Opening even large
+           files therefore only costs a scan for newlines.
+        """
+        from .lazytext import map_file
+        model = cls(**properties)
+        style = updated_style(cls.defaultstyle, properties)
+        model.texel = map_file(filename, encoding, style)
+        return model
+
+    # Appended content is collected in _tail and only joined with the
+    # tree when the texel is accessed. This makes appending amortized
+    # O(1), which is important for streams and logs.
+    _tail = None
+
+    def get_texel(self):
+        tail = self._tail
+        if tail is not None:
+            self._tail = None
+            with transient():
+                self._texel = grouped(fuse(strip2list(self._texel),
+                                           tail.get_list()))
+        return self._texel
+
+    def _get_tail(self):
+        if self.readonly:
+            raise TypeError("snapshots are read-only")
+        self.revision += 1
+        if self._tail is None:
+            self._tail = TextModelBuilder(self.__class__)
+        return self._tail
+
+    _changes = None # collects signals during a transaction
+
+    @contextmanager
+    def transaction(self):
+        """Combines all changes made in the with-block into one
+           "replaced" signal, which is emitted at the end of the block.
+        """
+        if self._changes is not None: # nested transaction
+            yield
+            return
+        self._changes = changes = _Changes()
+        try:
+            yield
+        finally:
+            del self._changes
+            if changes.a is not None:
+                self.notify_views('replaced', *changes.get_signal())
+
+    def notify_views(self, message='model_changed', *args, **kwds):
+        changes = self._changes
+        if changes is not None and changes.record(message, args):
+            return
+        Model.notify_views(self, message, *args, **kwds)
+
+    # The revision is increased with every change of the texel tree.
+    revision = 0
+    readonly = False
+
+    def set_texel(self, texel):
+        if self.readonly:
+            raise TypeError("snapshots are read-only")
+        self._tail = None
+        self._texel = texel
+        self.revision += 1
+
+    texel = overridable_property('texel', "The root of the texel tree.")
+
+    def snapshot(self):
+        """Returns a read-only copy of the model in its current state.
+
+           The snapshot shares the texel tree with the model and costs
+           O(1). Since texels are never changed once they are part of
+           a model, snapshots can be read from other threads while the
+           model is edited.
+        """
+        texel = self.texel # joins appended content
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        clone.__dict__.pop('_changes', None)
+        clone._tail = None
+        clone.readonly = True
+        return clone
+
     def __len__(self):
-        return length(self.texel)
+        n = length(self._texel)
+        if self._tail is not None:
+            n += len(self._tail)
+        return n
 
     def __getstate__(self):
         state = self.__dict__.copy()
+        state.pop('_tail', None)
+        state.pop('readonly', None)
+        state['texel'] = self.texel
+        del state['_texel']
         return state
 
     def __setstate__(self, state):
+        state = state.copy()
+        texel = state.pop('texel')
         self.__dict__ = state
+        self.texel = texel
 
     def get_xtexel(self):
         """Returns the texel tree extended by an ENDMARK glyph."""
@@ -105,8 +307,13 @@ class TextModel(Model):
         """Returns the number of lines."""
         return self.texel.weights[2]+1
 
-    def get_text(self, i1=None, i2=None):
-        """Retuns the text between *i1* and *i2* as unicode string."""
+    def iter_text(self, i1=None, i2=None, chunk_size=None):
+        """Iterates over the text between *i1* and *i2*.
+
+           Without *chunk_size* the pieces are the texts of the
+           leaves. Otherwise, all pieces except the last one have
+           exactly *chunk_size* characters.
+        """
         if i1 is None:
             i1 = 0
         if i2 is None:
@@ -115,17 +322,98 @@ class TextModel(Model):
             raise IndexError(i1)
         if i2>len(self):
             raise IndexError(i2)
-        return _get_text(self.texel, i1, i2)
+        pieces = texeltree.iter_text(self.texel, i1, i2)
+        if chunk_size:
+            return _chunked(pieces, chunk_size)
+        return pieces
+
+    def get_text(self, i1=None, i2=None):
+        """Retuns the text between *i1* and *i2* as unicode string."""
+        return u''.join(self.iter_text(i1, i2))
+
+    def finditer(self, pattern, i1=None, i2=None, reverse=False):
+        """Yields the index pairs (j1, j2) of all matches of *pattern*
+           between *i1* and *i2*.
+
+           *Pattern* is a string or a compiled regular expression. The
+           text is read in chunks, the document is never joined into
+           one string. Changes during the iteration are not seen.
+        """
+        if i1 is None:
+            i1 = 0
+        if i2 is None:
+            i2 = length(self.texel)
+        return finditer(self.texel, pattern, i1, i2, reverse)
 
     def get_style(self, i):
         """Returns the style at index *i*."""
         return get_style(self.get_xtexel(), i)
 
     def get_parstyle(self, i):
-        row, col = self.index2position(i)
-        j = self.lineend(row)
-        texel = _get_texel(self.get_xtexel(), j)
-        return texel.parstyle
+        return self.locate(i).parstyle
+
+    def locate(self, i):
+        """Returns a Location with all positional facts about index *i*.
+
+           These are row, col, the start and end of the line (as in
+           linestart and lineend), the leaf texel containing *i*, the
+           offset in the leaf, the style and the paragraph style.
+        """
+        return self.locate_many([i])[0]
+
+    def locate_many(self, indices):
+        """Returns the Locations for all *indices*, which must be sorted.
+
+           Neighbouring indices share the path from the root, so that
+           locating nearby indices is cheaper than calling locate.
+        """
+        root = self.get_xtexel()
+        n = length(root)
+        r = []
+        path = [] # entries (group, start, row, k)
+        last = 0
+        for i in indices:
+            if not 0 <= i < n:
+                raise IndexError(i)
+            if i < last:
+                raise ValueError("Indices must be sorted.")
+            last = i
+            while path and i >= path[-1][1]+length(path[-1][0]):
+                path.pop()
+            if path:
+                texel, start, row, k = path.pop()
+            else:
+                texel, start, row = root, 0, 0
+            while provides_childs(texel):
+                offsets = texel.cumulated[1]
+                k = bisect_right(offsets, i-start)-1
+                path.append((texel, start, row, k))
+                row += texel.cumulated[2][k]
+                start += offsets[k]
+                texel = texel.childs[k]
+            leaf = texel
+            offset = i-start
+            if leaf.is_text and leaf.weights[2]:
+                linestarts = leaf.get_linestarts()
+                m = bisect_right(linestarts, offset)
+            else:
+                linestarts = ()
+                m = 0
+            if m:
+                linestart = start+linestarts[m-1]
+            else:
+                linestart = _line_start(path)
+            if m < len(linestarts):
+                lineend = start+linestarts[m]-1
+                parleaf = leaf
+            elif leaf.weights[2] and not leaf.is_text: # a NewLine
+                lineend = i
+                parleaf = leaf
+            else:
+                lineend, parleaf = _line_end(path)
+            r.append(Location(row+m, i-linestart, linestart, lineend, leaf,
+                              offset, leaf.style, parleaf.parstyle))
+        return r
 
     def position2index(self, row, col):
         """Returns the index corresponding to *row* and *col*."""
@@ -197,8 +485,9 @@ class TextModel(Model):
         if not (-1 <= i1 <= i2 <= len(self)):
             raise IndexError((i1, i2))
         memo = get_styles(self.texel, i1, i2)
-        self.texel = grouped(
-            set_properties(self.texel, i1, i2, properties))
+        with transient():
+            self.texel = grouped(
+                set_properties(self.texel, i1, i2, properties))
         #assert check(self.texel)
         self.notify_views('properties_changed', i1, i2)
         return memo
@@ -210,18 +499,115 @@ class TextModel(Model):
         n = sum([entry[0] for entry in styles])
         memo = get_styles(self.texel, i, i+n)
         iterator = StyleIterator(iter(styles))
-        self.texel = grouped(
-            set_styles(self.texel, i, iterator))
+        with transient():
+            self.texel = grouped(
+                set_styles(self.texel, i, iterator))
         self.notify_views('properties_changed', i, i+n)
         return memo
 
+    def apply_styles(self, spans):
+        """Sets the styles of many spans in one pass.
+
+           *spans* is a list of tuples (i1, i2, properties) sorted by
+           index and not overlapping. *properties* is either a dict of
+           text properties, which are updated, or a style, which
+           replaces the old style. Views are notified once. Returns the
+           old styles from the first *i1* on (see set_styles).
+        """
+        if not spans:
+            return []
+        i1 = spans[0][0]
+        i2 = spans[-1][1]
+        if not (0 <= i1 <= i2 <= len(self)):
+            raise IndexError((i1, i2))
+        memo = get_styles(self.texel, i1, i2)
+        iterator = StyleIterator(iter(apply_spans(memo, i1, spans)))
+        with transient():
+            self.texel = grouped(
+                set_styles(self.texel, i1, iterator))
+        self.notify_views('properties_changed', i1, i2)
+        return memo
+
+    def apply_edits(self, edits):
+        """Applies many changes in one go.
+
+           *edits* is a list of tuples (i1, i2, replacement) sorted by
+           index and not overlapping. The data between *i1* and *i2* is
+           replaced by *replacement*, which is a textmodel or a unicode
+           string. If *replacement* is a dict, the text is kept and its
+           properties are updated. Views are notified once. Returns a
+           list of edits which restores the old content.
+        """
+        if not edits:
+            return []
+        j = 0
+        for i1, i2, replacement in edits:
+            if i1 < j or i2 < i1:
+                raise ValueError("Edits must be sorted and must not overlap.")
+            j = i2
+        if edits[0][0] < 0 or j > len(self):
+            raise IndexError((edits[0][0], j))
+
+        texel = self.texel
+        parts = []
+        models = {} # replacement string -> textmodel
+        for i1, i2, replacement in edits:
+            if isinstance(replacement, dict):
+                part = grouped(texeltree.copy(texel, i1, i2))
+                if i1 < i2:
+                    part = grouped(
+                        set_properties(part, 0, i2-i1, replacement))
+            elif isinstance(replacement, TextModel):
+                part = replacement.texel
+            else:
+                model = models.get(replacement)
+                if model is None:
+                    model = models[replacement] = \
+                        self.create_textmodel(replacement)
+                part = model.texel
+            parts.append(part)
+
+        # The new tree is built in one pass from left to right, which
+        # is much faster than takeout and insert for many edits.
+        ranges = [(i1, i2) for (i1, i2, replacement) in edits]
+        self.texel, kernels = texeltree.splice(texel, ranges, parts)
+        olds = []
+        for kernel in kernels:
+            old = self.create_textmodel()
+            old.texel = kernel
+            olds.append(old)
+
+        memo = []
+        delta = 0
+        for (i1, i2, replacement), part, old in zip(edits, parts, olds):
+            j1 = i1+delta
+            memo.append((j1, j1+length(part), old))
+            delta += length(part)-(i2-i1)
+        i1 = edits[0][0]
+        i2 = edits[-1][1]
+        self.notify_views('replaced', i1, i2, i2-i1+delta)
+        return memo
+
+    def replace_all(self, pattern, replacement, i1=None, i2=None):
+        """Replaces all matches of *pattern* between *i1* and *i2*.
+
+           *Pattern* is searched as in finditer. *Replacement* is a
+           unicode string or a textmodel. All matches are replaced
+           by one apply_edits, so views are notified once. Returns a
+           list of edits which restores the old content.
+        """
+        edits = [(j1, j2, replacement) for (j1, j2)
+                 in self.finditer(pattern, i1, i2)]
+        return self.apply_edits(edits)
+
     def set_parproperties(self, i1, i2, **properties):
         """Sets the paragraph properties between *i1* and *i2*."""
         if not (0 <= i1 <= i2 <= len(self)):
             raise IndexError((i1, i2))
         memo = get_parstyles(self.texel, i1, i2)
-        self.texel = grouped(
-            set_parproperties(self.texel, i1, i2, properties))
+        with transient():
+            self.texel = grouped(
+                set_parproperties(self.texel, i1, i2, properties))
         #assert check(self.texel)
         self.notify_views('properties_changed', i1, i2)
         return memo
@@ -233,8 +619,9 @@ class TextModel(Model):
         n = sum([entry[0] for entry in styles])
         memo = get_parstyles(self.texel, i, i+n)
         iterator = StyleIterator(iter(styles))
-        self.texel = grouped(
-            set_parstyles(self.texel, i, iterator))
+        with transient():
+            self.texel = grouped(
+                set_parstyles(self.texel, i, iterator))
         self.notify_views('properties_changed', i, i+n)
         return memo
 
@@ -250,18 +637,27 @@ class TextModel(Model):
         row, col = self.index2position(i)
         n = length(self.texel) + length(text.texel)
         stuff = strip2list(text.texel)
-        tmp = grouped(insert(self.texel, i, stuff))
-        self.texel = tmp
+        with transient():
+            self.texel = grouped(insert(self.texel, i, stuff))
         assert length(self.texel) == n
         self.notify_views('inserted', i, len(text))
 
     def append(self, text):
-        """Appends textmodel *texel*."""
-        return self.insert(len(self), text)
+        """Appends textmodel *text*."""
+        i = len(self)
+        self._get_tail().append_texel(text.texel)
+        self.notify_views('inserted', i, len(text))
 
     def append_text(self, text, **properties):
         """Appends unicode text."""
-        return self.insert_text(len(self), text, **properties)
+        i = len(self)
+        tail = self._get_tail()
+        if properties:
+            style = updated_style(self.defaultstyle, properties)
+        else:
+            style = None # the default style
+        tail.append_text(text, style)
+        self.notify_views('inserted', i, len(self)-i)
 
     def insert_text(self, i, text, **properties):
         """Inserts a unicode text string *text* at index *i*.""" 
@@ -270,12 +666,8 @@ class TextModel(Model):
 
     def copy(self, i1, i2):
         """Returns a copy of all data between *i1* and *i2*."""
-        row1, col1 = self.index2position(i1)
-        row2, col2 = self.index2position(i2)
-
-        rest, removed = takeout(self.texel, i1, i2)
         model = self.create_textmodel()
-        model.texel = grouped(removed)
+        model.texel = grouped(texeltree.copy(self.texel, i1, i2))
         return model
 
     def __add__(self, other):
@@ -309,17 +701,135 @@ class TextModel(Model):
         row1, col1 = self.index2position(i1)
         row2, col2 = self.index2position(i2)
 
-        rest, kern = takeout(self.texel, i1, i2)
-        self.texel = grouped(rest)
+        with transient():
+            rest, kern = takeout(self.texel, i1, i2)
+            self.texel = grouped(rest)
+            kern = grouped(kern)
 
         model = self.create_textmodel()
-        model.texel = grouped(kern)
+        model.texel = kern
 
         self.notify_views('removed', i1, model)
         #assert check(self.texel)
         return model
 
 
+    def compact(self, i=0, n=None):
+        """Merges fragmented leaves and rebalances the texel tree.
+
+           Starts at index *i*. If *n* is given, only about *n* leaves
+           are processed, so that compaction can be done in small
+           slices, e.g. in an idle handler. Returns the index at which
+           compaction stopped, i.e. len(self) when it is finished.
+
+           The content is not changed and views are not notified.
+        """
+        if not (0 <= i <= len(self)):
+            raise IndexError(i)
+        if n is None:
+            j = len(self)
+        else:
+            j = skip_leaves(self.texel, i, n)
+        self.texel = grouped(compact(self.texel, i, j))
+        return j
+
+
+class TextModelBuilder:
+    """Creates a TextModel from a stream of chunks.
+
+    Chunks are either tuples (text, style) or texels. The texel tree
+    is packed bottom up while the chunks arrive, so that the complete
+    text never has to be held as a single string:
+
+    >>> builder = TextModelBuilder()
+    >>> for i in range(3):
+    ...     builder.append_text("Line %i\n" % i)
+    >>> builder.get_model().nlines()
+    4
+    """
+    def __init__(self, model_class=None, **properties):
+        if model_class is None:
+            model_class = TextModel
+        self.model_class = model_class
+        self.defaultstyle = updated_style(model_class.defaultstyle, properties)
+        self.builder = TreeBuilder()
+        self._raw = None # last style passed in and its interned version
+        self._style = None
+        self._pending = [] # text not yet converted into leaves
+        self._npending = 0
+
+    def __len__(self):
+        return self.builder.length+self._npending
+
+    def extend(self, chunks):
+        """Appends all chunks from the iterable *chunks*."""
+        for chunk in chunks:
+            if isinstance(chunk, Texel):
+                self.append_texel(chunk)
+            else:
+                self.append_text(*chunk)
+
+    def append_text(self, text, style=None):
+        """Appends *text* with *style* (defaults to the default style)."""
+        if style is None:
+            style = self.defaultstyle
+        elif style is not self._raw:
+            self._raw = style
+            style = as_style(style)
+        if style is not self._style:
+            self._flush()
+            self._style = style
+        # parts alternates between text and separators and always
+        # ends with text
+        parts = _split(text.replace('\r', ''))
+        tail = parts.pop()
+        leaves = []
+        if parts:
+            if self._pending:
+                self._pending.append(parts[0])
+                parts[0] = u''.join(self._pending)
+                self._pending = []
+                self._npending = 0
+            for k in range(0, len(parts), 2):
+                part = parts[k]
+                if part:
+                    leaves.extend(text_leaves(part, style))
+                leaves.append(interned(Tabulator(style)))
+        if tail:
+            self._pending.append(tail)
+            self._npending += len(tail)
+            if self._npending >= texeltree.maxtext:
+                leaves.extend(self._take_pending())
+        if leaves:
+            self.builder.extend(leaves)
+
+    def append_texel(self, texel):
+        """Appends *texel*, which must be root efficient."""
+        self._flush()
+        self.builder.append(texel)
+
+    def _take_pending(self):
+        # Returns the pending text as list of leaves
+        text = u''.join(self._pending)
+        self._pending = []
+        self._npending = 0
+        return text_leaves(text, self._style)
+
+    def _flush(self):
+        if self._pending:
+            self.builder.extend(self._take_pending())
+
+    def get_list(self):
+        """Returns all content appended so far as list efficient list."""
+        self._flush()
+        return self.builder.get_list()
+
+    def get_model(self):
+        """Returns a new model with all content appended so far."""
+        model = self.model_class()
+        model.texel = grouped(self.get_list())
+        return model
+
 
 def pycolorize(rawtext, coding='latin-1'): # XXX is latin-1 ok?
     # used for benchmarking
@@ -347,6 +857,7 @@ def pycolorize(rawtext, coding='latin-1'): # XXX is latin-1 ok?
     text = rawtext.decode(coding)    
     model = TextModel(text)
 
+    spans = []
     for t in tokenize.tokenize(instream):
         toktype = t.type
         if token.LPAR <= toktype and toktype <= token.OP:
@@ -359,8 +870,8 @@ def pycolorize(rawtext, coding='latin-1'): # XXX is latin-1 ok?
             erow, ecol = t.end
             i1 = model.position2index(srow-1, scol)
             i2 = model.position2index(erow-1, ecol)
-            model.set_properties(i1, i2, textcolor=color)            
-
+            spans.append((i1, i2, dict(textcolor=color)))
+    model.apply_styles(spans)
     return model.copy(0, len(model)-1)
 
 
@@ -739,4 +1250,335 @@ def test_19():
     model.set_parproperties(0, len(model), textcolor='red')
     assert model.get_parstyle(1) == {'textcolor':'red'}
 
-__all__ = ['TextModel']
+def test_20():
+    "compact"
+    model = TextModel()
+    model.texel = grouped([Text(c) for c in text1+text2])
+    model.set_properties(5, 15, fontsize=12)
+    n = len(get_pieces(model.texel))
+    styles = get_styles(model.texel, 0, len(model))
+    i = 0
+    while i < len(model):
+        i = model.compact(i, 4)
+    assert model.get_text() == text1+text2
+    assert get_styles(model.texel, 0, len(model)) == styles
+    assert len(get_pieces(model.texel)) == 3 < n
+    assert model.compact() == len(model)
+
+def test_21():
+    "TextModelBuilder"
+    s1 = create_style(fontsize=12)
+    text = text1+'\n'+text2+'\t'+text3
+    builder = TextModelBuilder()
+    for c in text:
+        builder.append_text(c)
+    assert len(builder) == len(text)
+    model = builder.get_model()
+    assert model.get_text() == text
+    assert get_pieces(model.texel) == get_pieces(TextModel(text).texel)
+
+    builder = TextModelBuilder(fontsize=10)
+    builder.extend([
+        (text1, None),
+        (text2, s1),
+        TextModel(text3).texel,
+        (text1, dict(fontsize=12))])
+    model = builder.get_model()
+    assert model.get_text() == text1+text2+text3+text1
+    assert model.get_style(0)['fontsize'] == 10
+    assert model.get_style(len(text1)) is s1
+    assert model.get_style(len(model)-1) is s1
+    assert is_root_efficient(model.texel)
+
+def test_22():
+    "append"
+    model = TextModel()
+    text = ''
+    for i in range(200):
+        line = "Line %i\n" % i
+        model.append(TextModel(line, fontsize=i%3))
+        text += line
+        assert len(model) == len(text)
+        if i % 37 == 0:
+            assert model.get_text() == text
+            model.insert_text(0, "x")
+            text = "x"+text
+    assert model.get_text() == text
+    assert is_root_efficient(model.texel)
+    assert model.nlines() == 201
+
+    from pickle import dumps, loads
+    model.append_text("tail")
+    model2 = loads(dumps(model))
+    assert model2.get_text() == text+"tail"
+
+def test_23():
+    "multi-line leaves"
+    text = "\n".join(["Line %i" % i for i in range(500)])
+    model = TextModel(text)
+    assert model.nlines() == 500
+    assert len(get_pieces(model.texel)) < 10
+    for row in (0, 1, 77, 499):
+        i = text.index("Line %i" % row)
+        assert model.linestart(row) == i
+        assert model.index2position(i+3) == (row, 3)
+        assert model.linelength(row) == len("Line %i" % row)+(row < 499)
+
+    i1 = model.linestart(77)
+    model.set_parproperties(i1, model.lineend(77)+1, base='h1')
+    assert model.get_parstyle(i1) == {'base':'h1'}
+    assert model.get_parstyle(model.linestart(78)) == {}
+    assert model.get_parstyle(0) == {}
+    assert model.get_text() == text
+    assert model.linestart(78) == text.index("Line 78")
+
+
+def test_24():
+    "apply_styles"
+    from .styles import create_style
+    text = (text1+'\n'+text2+'\t')*20
+    s1 = create_style(fontsize=14)
+    spans = [(3, 7, dict(bold=True)), (7, 9, s1), (9, 9, s1),
+             (20, 100, dict(textcolor='red')), (150, 200, dict(bold=True))]
+    model1 = TextModel(text)
+    model1.set_properties(40, 60, fontsize=10)
+    model2 = model1.copy(0, len(model1))
+    for i1, i2, properties in spans:
+        if type(properties) is dict:
+            model1.set_properties(i1, i2, **properties)
+        else:
+            model1.set_styles(i1, [(i2-i1, properties)])
+    memo = model2.apply_styles(spans)
+    styles = get_styles(model1.texel, 0, len(model1))
+    assert get_styles(model2.texel, 0, len(model2)) == styles
+    assert model2.get_style(45) == dict(fontsize=10, textcolor='red')
+    assert model2.get_text() == text
+
+    model2.set_styles(3, memo)
+    assert get_styles(model2.texel, 0, len(model2)) == \
+        [(40, EMPTYSTYLE), (20, create_style(fontsize=10)), 
+         (len(text)-60, EMPTYSTYLE)]
+    try:
+        model2.apply_styles([(5, 10, s1), (8, 12, s1)])
+        assert False
+    except ValueError:
+        pass
+
+def test_25():
+    "locate"
+    from . import texeltree
+    model = TextModel((text1+'\n'+text3+'\t'+text2)*3)
+    model.set_parproperties(20, 30, base='h1')
+    model.set_properties(5, 25, bold=True)
+    model.insert(15, TextModel(text3, fontsize=14))
+    n = len(model)
+    for nmax in (4, 16):
+        texeltree.set_nmax(nmax)
+        model.texel = texeltree.grouped(texeltree.copy(model.texel, 0, n))
+        locations = model.locate_many(list(range(n+1)))
+        for i in range(n+1):
+            location = model.locate(i)
+            assert location == locations[i]
+            row, col = model.index2position(i)
+            assert (location.row, location.col) == (row, col)
+            assert location.linestart == model.linestart(row)
+            assert location.lineend == model.lineend(row)
+            assert location.style is model.get_style(i)
+            assert location.texel is _get_texel(model.get_xtexel(), i)
+            j = model.lineend(row)
+            assert location.parstyle is _get_texel(model.get_xtexel(), j).parstyle
+    texeltree.set_nmax(16)
+    assert model.locate(n).texel.is_endmark
+    assert dict(base='h1') in [l.parstyle for l in locations]
+    try:
+        model.locate_many([5, 3])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_26():
+    "iter_text"
+    model = TextModel(u"0123456789\n"*200)
+    model.set_properties(5, 15, bold=True)
+    model.insert_text(1000, u"x")
+    text = model.get_text()
+    assert len(list(model.iter_text())) > 1
+    chunks = list(model.iter_text(3, 2000, 100))
+    assert u''.join(chunks) == text[3:2000]
+    assert [len(c) for c in chunks] == [100]*19+[97]
+    assert list(model.iter_text(0, 0, 100)) == []
+    try:
+        model.iter_text(0, len(model)+1)
+        assert False
+    except IndexError:
+        pass
+
+
+def test_27():
+    "apply_edits"
+    model = TextModel(u"Line 1\nLine 2\nLine 3\n")
+    text = model.get_text()
+    signals = []
+    class View:
+        def model_changed(self, model):
+            signals.append('changed')
+        def replaced(self, model, i1, i2, n):
+            signals.append((i1, i2, n))
+    view = View()
+    model.add_view(view)
+    edits = [(0, 0, u'    '), (5, 6, u'one'), (7, 11, TextModel(u"Row")),
+             (14, 20, dict(bold=True))]
+    memo = model.apply_edits(edits)
+    assert model.get_text() == u"    Line one\nRow 2\nLine 3\n"
+    assert signals == [(0, 20, 25)]
+    assert model.get_style(20)['bold']
+    assert not model.get_style(13).get('bold')
+
+    model.apply_edits(memo)
+    assert model.get_text() == text
+    assert not model.get_style(14).get('bold')
+    assert model.apply_edits([]) == []
+    for edits in ([(3, 5, u''), (4, 6, u'')], [(3, 2, u'')]):
+        try:
+            model.apply_edits(edits)
+            assert False
+        except ValueError:
+            pass
+    try:
+        model.apply_edits([(0, len(model)+1, u'')])
+        assert False
+    except IndexError:
+        pass
+
+
+def test_28():
+    "transaction"
+    model = TextModel(u"0123456789")
+    signals = []
+    class View:
+        def model_changed(self, model):
+            signals.append('changed')
+        def replaced(self, model, i1, i2, n):
+            signals.append((i1, i2, n))
+    model.add_view(View())
+    with model.transaction():
+        model.insert_text(8, u'abc')
+        model.remove(2, 4)
+        with model.transaction():
+            model.set_properties(0, 1, bold=True)
+        assert signals == []
+    assert model.get_text() == u"014567abc89"
+    assert signals == [(0, 8, 9)]
+    assert model._changes is None
+
+    # all indices outside of the signalled range are unchanged
+    import random
+    for k in range(100):
+        model = TextModel(u"0123456789"*3)
+        del signals[:]
+        model.add_view(View())
+        old = model.get_text()
+        with model.transaction():
+            for j in range(3):
+                i1 = random.randrange(len(model)+1)
+                i2 = random.randrange(i1, len(model)+1)
+                if random.randrange(2):
+                    model.remove(i1, i2)
+                else:
+                    model.insert_text(i1, u'x'*(i2-i1))
+        new = model.get_text()
+        if not signals:
+            assert new == old
+            continue
+        (i1, i2, n), = signals
+        assert new[:i1] == old[:i1]
+        assert new[i1+n:] == old[i2:]
+
+
+def test_29():
+    "snapshot and revision"
+    model = TextModel(u"Hello\nworld")
+    r0 = model.revision
+    snapshot = model.snapshot()
+    assert snapshot.texel is model.texel
+    assert snapshot.revision == r0
+    model.insert_text(5, u"!")
+    model.append_text(u"\nmore")
+    assert model.revision > r0+1
+    assert snapshot.get_text() == u"Hello\nworld"
+    assert snapshot.revision == r0
+    assert model.snapshot().get_text() == u"Hello!\nworld\nmore"
+    for f, args in ((snapshot.insert_text, (0, u"x")),
+                    (snapshot.remove, (0, 1)),
+                    (snapshot.set_properties, (0, 1)),
+                    (snapshot.append_text, (u"x",))):
+        try:
+            f(*args)
+            assert False
+        except TypeError:
+            pass
+    assert snapshot.get_text() == u"Hello\nworld"
+    copy = snapshot.copy(0, 5)
+    copy.insert_text(0, u"x") # copies are not read-only
+    from pickle import loads, dumps
+    assert not loads(dumps(snapshot)).readonly
+
+    # reading while the model is edited in another thread
+    import threading
+    model = TextModel(u"0123456789\n"*1000)
+    snapshot = model.snapshot()
+    text = snapshot.get_text()
+    results = []
+    def read():
+        for i in range(50):
+            results.append(snapshot.get_text() == text and
+                           snapshot.nlines() == 1001)
+    thread = threading.Thread(target=read)
+    thread.start()
+    for i in range(200):
+        model.insert_text(i*7, u"abc\n")
+        model.set_properties(i, i+5, bold=True)
+    thread.join()
+    assert all(results) and len(results) == 50
+
+def test_30():
+    "finditer"
+    import re
+    model = TextModel(u"Hello world, hello moon\n"*100)
+    model.set_properties(0, 3, bold=True)
+    assert len(list(model.finditer(u"hello"))) == 100
+    found = list(model.finditer(re.compile(u"hello", re.I), 0, 28))
+    assert found == [(0, 5), (13, 18)]
+    assert list(model.finditer(u"n\nH", reverse=True))[0] == (2374, 2377)
+    matches = model.finditer(u"moon")
+    model.remove(0, len(model)) # not seen by the iteration
+    assert len(list(matches)) == 100
+
+
+def test_31():
+    "replace_all"
+    import re
+    model = TextModel(u"Hello world, hello moon\n"*1000)
+    model.set_properties(0, 24, bold=True)
+    signals = []
+    class Listener:
+        def replaced(self, *args):
+            signals.append(args)
+    model.add_view(Listener())
+    text = model.get_text()
+    memo = model.replace_all(re.compile(u"hello", re.I), u"bye")
+    assert len(memo) == 2000
+    assert model.get_text() == re.sub(u"(?i)hello", u"bye", text)
+    assert model.get_style(4)['bold']
+    assert signals == [(model, 0, len(text)-6, len(model)-6)]
+    model.apply_edits(memo)
+    assert model.get_text() == text
+    assert model.get_style(0)['bold']
+    assert model.replace_all(u"xyz", u"") == []
+    assert len(signals) == 2
+    model.replace_all(u"moon", TextModel(u"sun"), 0, 100)
+    assert model.get_text(0, 115).count(u"sun") == 4
+
+
+__all__ = ['TextModel', 'TextModelBuilder']
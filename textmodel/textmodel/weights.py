@@ -1,7 +1,9 @@
 # -*- coding: latin-1 -*-
 
 
-from .texeltree import length, provides_childs, iter_childs, Texel
+from .texeltree import length, provides_childs, iter_childs, Texel, \
+    builtin_weights, weight, cumulated_weight, copy
+from bisect import bisect_left, bisect_right
 
 
 debug = 0
@@ -15,19 +17,28 @@ class NotFound(Exception):
 # work with certain weight functions. They will work for weights
 # aggregated by 'sum', such as lengths and line numbers. But trying to
 # find depth values will lead to unexpected and unpredicted behaviour.
+#
+# Weights are given by their index in texel.weights or by name (see
+# texeltree.register_weight).
 
 def find_weight(texel, w, windex):
     """Returns position *i* at which weight *windex* switches to value *w*."""
     assert type(w) is int
+    if not isinstance(windex, int):
+        if windex not in builtin_weights:
+            return _find_registered(texel, w, windex)
+        windex = builtin_weights[windex]
     if w == 0:
         return 0
     if provides_childs(texel):
-        sum_w = 0
-        for i1, i2, child in iter_childs(texel):
-            delta = child.weights[windex]
-            if sum_w+delta >= w:
-                return find_weight(child, w-sum_w, windex)+i1
-            sum_w += delta
+        sums = texel.cumulated[windex]
+        k = bisect_left(sums, w, 1)-1 # first child with sum >= w
+        if k < len(texel.childs):
+            return find_weight(texel.childs[k], w-sums[k], windex)+\
+                texel.cumulated[1][k]
+    elif windex == 2 and texel.is_text and 0 < w <= texel.weights[2]:
+        # a leaf containing several lines
+        return texel.get_linestarts()[w-1]
     if w == texel.weights[windex]:
         return length(texel)
     raise NotFound(w)
@@ -52,6 +63,10 @@ def get_weight(texel, windex, i):
     """
     if i<0:
         raise IndexError
+    if not isinstance(windex, int):
+        if windex not in builtin_weights:
+            return _get_registered(texel, windex, i)
+        windex = builtin_weights[windex]
     if i >= length(texel):
         return texel.weights[windex]
     w = 0
@@ -59,16 +74,60 @@ def get_weight(texel, windex, i):
         return w
 
     if provides_childs(texel):
-        for i1, i2, child in iter_childs(texel):
-            if i2 <= i:
-                w += child.weights[windex]
-            elif i1 <= i <= i2:
-                w += get_weight(child, windex, i-i1)
-            else:
-                break
+        offsets = texel.cumulated[1]
+        k = bisect_right(offsets, i)-1 # child with i1 <= i < i2
+        w = texel.cumulated[windex][k]+\
+            get_weight(texel.childs[k], windex, i-offsets[k])
+    elif windex == 2 and texel.is_text and texel.weights[2]:
+        # a leaf containing several lines
+        w = bisect_right(texel.get_linestarts(), i)
     return w
 
 
+def _leaf_weight(texel, name, i):
+    # Returns weight *name* of the first *i* characters of a leaf
+    return sum([weight(piece, name) for piece in copy(texel, 0, i)])
+
+
+def _find_registered(texel, w, name):
+    if w == 0:
+        return 0
+    if provides_childs(texel):
+        sums = cumulated_weight(texel, name)
+        k = bisect_left(sums, w, 1)-1 # first child with sum >= w
+        if k < len(texel.childs):
+            return _find_registered(texel.childs[k], w-sums[k], name)+\
+                texel.cumulated[1][k]
+    elif texel.is_text and 0 < w <= weight(texel, name):
+        # smallest i at which the weight reaches w
+        lo = 1
+        hi = length(texel)
+        while lo < hi:
+            m = (lo+hi) // 2
+            if _leaf_weight(texel, name, m) < w:
+                lo = m+1
+            else:
+                hi = m
+        if _leaf_weight(texel, name, lo) == w:
+            return lo
+    if w == weight(texel, name):
+        return length(texel)
+    raise NotFound(w)
+
+
+def _get_registered(texel, name, i):
+    if i >= length(texel):
+        return weight(texel, name)
+    if i == 0:
+        return 0
+    if provides_childs(texel):
+        offsets = texel.cumulated[1]
+        k = bisect_right(offsets, i)-1 # child with i1 <= i < i2
+        return cumulated_weight(texel, name)[k]+\
+            _get_registered(texel.childs[k], name, i-offsets[k])
+    return _leaf_weight(texel, name, i)
+
+
 if debug: # enable contract checking
      import contract
      contract.checkmod(__name__)
@@ -64,6 +64,20 @@ def test_02(): # 13.7s
 def test_03(): # 3.1s
     create_view()
 
+def append_to_view(nlines=3000):
+    # Appends lines to a model with a view attached, like a log window
+    app = wx.App(False)
+    frame = wx.Frame(None)
+    view = WXTextView(frame, -1)
+    model = view.model
+    for i in range(nlines):
+        model.append_text("Line %i: test test test test\n" % i)
+    view.layout
+
+def test_04(): # 0.1s with the test device (9.7s when every append
+               # updated the layout)
+    append_to_view()
+
 def demo_00():
     create_text()
     colorize()
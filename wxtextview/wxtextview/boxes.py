@@ -76,8 +76,11 @@ def strip(box):
     return box
 
 
-class Box:
-    # Boxes are the basic building blocks of a layout.
+class Box(object):
+    # Boxes are the basic building blocks of a layout. The frequent
+    # boxes (TextBox and the ChildBox family) use slots, classes derived
+    # without __slots__ get a __dict__ as usual.
+    __slots__ = ()
     width = 0
     height = 0
     depth = 0
@@ -85,6 +88,13 @@ class Box:
     is_group = False # we will use this as base class for groups and
                      # non groups
 
+    def __getattr__(self, name):
+        # Only called for attributes which are not set, e.g. slots
+        # which shadow the defaults above.
+        if name in ('width', 'height', 'depth', 'device'):
+            return getattr(Box, name)
+        raise AttributeError(name)
+
     def create_group(self, l):
         return SimpleGroupBox(l, device=self.device)
 
@@ -278,6 +288,7 @@ class Box:
 
     
 class _TextBoxBase(Box):
+    __slots__ = ()
     def __len__(self):
         return len(self.text)
 
@@ -344,6 +355,7 @@ class _TextBoxBase(Box):
 
 
 class TextBox(_TextBoxBase):
+    __slots__ = ('text', 'style', 'device', 'width', 'height')
     def __init__(self, text, style=EMPTYSTYLE, device=None):
         self.text = text
         self.style = style
@@ -448,6 +460,7 @@ class ChildBox(Box):
     # certain way (e.g. HBox, VBox, HGroup, ...). It is assumed, that
     # boxes are dense, i.e. there is no gap between child
     # boxes. Further it is necessary that childboxes can be grouped.
+    __slots__ = ('childs', 'device', 'width', 'height', 'depth', 'length')
     
     def __init__(self, childs, device=None):
         if device is not None:
@@ -490,6 +503,7 @@ class ChildBox(Box):
 
 class HBox(ChildBox):
     # A box which aligns its child boxes horizontaly. 
+    __slots__ = ()
     def iter_boxes(self, i, x, y):
         height = self.height
         j1 = i
@@ -524,11 +538,12 @@ class HBox(ChildBox):
 
 
 class Row(HBox):
-    pass
+    __slots__ = ()
 
 
 class VBox(ChildBox):
     # A box which aligns its child boxes vertically.
+    __slots__ = ()
     def iter_boxes(self, i, x, y):
         j1 = i
         for child in self.childs:
@@ -556,6 +571,7 @@ class SimpleGroupBox(ChildBox):
     # This Box is used as a dummy group to be able to temporarily
     # combine boxes. This is needed because treebase requires that all
     # elements have a corresponding group class.
+    __slots__ = ()
     is_group = 1
     def iter_boxes(self, i, x, y):
         height = self.height
@@ -573,6 +589,7 @@ class SimpleGroupBox(ChildBox):
 
 class HGroup(HBox):
     # A group which aligns its child boxes horizontaly. 
+    __slots__ = ()
     is_group = True
     def create_group(self, l):
         return HGroup(l, device=self.device)
@@ -581,6 +598,7 @@ class HGroup(HBox):
 
 class VGroup(VBox):
     # A group which aligns its child boxes vertically. 
+    __slots__ = ()
     is_group = True
     def create_group(self, l):
         return VGroup(l, device=self.device)
@@ -4,7 +4,7 @@
 from ..textmodel import texeltree
 from ..textmodel.textmodel import TextModel
 from ..textmodel.texeltree import NewLine, Group, Text, length
-from ..textmodel.styles import EMPTYSTYLE
+from ..textmodel.styles import EMPTYSTYLE, updated_style
 from .testdevice import TESTDEVICE
 from .boxes import TextBox, NewlineBox, TabulatorBox, EmptyTextBox, \
     EndBox, check_box, Box, calc_length
@@ -36,9 +36,7 @@ class Factory:
         # This can overriden e.g. to implement style sheets. The
         # default behaviour is to use the paragraph style and add the
         # text styles.
-        r = self.parstyle.copy()
-        r.update(style)
-        return r
+        return updated_style(self.parstyle, style)
 
     ### Factory methods
     def create_all(self, texel):
@@ -51,9 +49,8 @@ class Factory:
         assert i1<=i2
         if i1 == i2:
             return () # XXX Why is this needed?
-        name = texel.__class__.__name__+'_handler'
-        handler = getattr(self, name)
-        #print "calling handler", name, i1, i2
+        handler = self.get_handler(texel)
+        #print "calling handler", handler, i1, i2
         l = handler(texel, i1, i2)
         try:
             assert calc_length(l) == i2-i1
@@ -61,6 +58,17 @@ class Factory:
             print("handler=", handler)
             raise
         return tuple(l)
+
+    def get_handler(self, texel):
+        # Returns the handler method for *texel*. Texel classes
+        # without a handler of their own use the handler of their base
+        # class, e.g. the text leaves of lazytext are handled as
+        # Lines.
+        for cls in texel.__class__.__mro__:
+            handler = getattr(self, cls.__name__+'_handler', None)
+            if handler is not None:
+                return handler
+        raise AttributeError(texel.__class__.__name__+'_handler')
         
     def Group_handler(self, texel, i1, i2):
         # Handles group texels. Note that the list of childs is
@@ -83,7 +91,8 @@ class Factory:
     _cache_keys = []
     def Text_handler(self, texel, i1, i2):
         # cached version
-        key = texel.text, id(texel.style), id(self.parstyle), i1, i2, self.device
+        key = texel.text, texel.style.sid, self.parstyle.sid, i1, i2, \
+            self.device
         try:
             return self._cache[key]
         except: pass        
@@ -96,6 +105,28 @@ class Factory:
         self._cache[key] = r
         return r
 
+    def Lines_handler(self, texel, i1, i2):
+        return self.create_lines(texel, texel.text[i1:i2])
+
+    def create_lines(self, texel, text):
+        # Creates the boxes for *text*, which is part of the text leaf
+        # *texel* and can contain newlines. As in Group_handler the
+        # lines are traversed from right to left, so that the
+        # paragraph style is known before the line content is built.
+        parts = text.split('\n')
+        r = []
+        if parts[-1]:
+            r.append(self.TextBox(parts[-1], self.mk_style(texel.style),
+                                  self.device))
+        for part in reversed(parts[:-1]):
+            self.parstyle = texel.parstyle
+            r.append(self.NewlineBox(self.mk_style(texel.style), self.device))
+            if part:
+                r.append(self.TextBox(part, self.mk_style(texel.style),
+                                      self.device))
+        r.reverse()
+        return r
+
     def NewLine_handler(self, texel, i1, i2):
         self.parstyle = texel.parstyle
         if texel.is_endmark:
@@ -141,6 +172,9 @@ class BuilderBase:
     def removed(self, i, n):
         pass
 
+    def replaced(self, i1, i2, n):
+        self.rebuild()
+
 
 
 def test_01():
@@ -49,11 +49,10 @@ def simple_linewrap(boxes, maxw, tabstops=(), wordwrap=True,
     l = []
     rows = [l]
     w = 0
-    boxes = list(boxes[:])
+    stack = list(reversed(boxes)) # the next box is on top
     last = None
-    while boxes:
-        box = boxes[0]
-        boxes = boxes[1:]
+    while stack:
+        box = stack.pop()
         if not len(box):
             continue
         if w+box.width <= maxw:
@@ -77,7 +76,9 @@ def simple_linewrap(boxes, maxw, tabstops=(), wordwrap=True,
                 lastbox = l[k]
                 a, b = split_box(lastbox, j)
                 assert len(a)+len(b) == len(lastbox)
-                boxes = [b]+l[k+1:]+[box]+boxes
+                stack.append(box)
+                stack.extend(reversed(l[k+1:]))
+                stack.append(b)
                 del l[k:]            
                 l.append(a)
                 split_at_i = False
@@ -87,13 +88,13 @@ def simple_linewrap(boxes, maxw, tabstops=(), wordwrap=True,
         if split_at_i:
             if i == 0:
                 if len(l):
-                    boxes = [box]+boxes
+                    stack.append(box)
                 else:
                     l.append(box)
             else:
                 a, b = split_box(box, i)
                 l.append(a)                    
-                boxes = [b]+boxes
+                stack.append(b)
             
         # start a new line
         w = 0
@@ -42,6 +42,7 @@ class Paragraph(VBox):
     #
     # The number of paragraphs can be very long. Therefore we group
     # paragraph into VGroups. This makes the GUI considerably faster.
+    __slots__ = ()
 
     def create_group(self, l):
         return VGroup(l, device=self.device)
@@ -192,6 +193,14 @@ class Builder(BuilderBase, Factory):
         new = self.create_paragraphs(texel, j1, j2-n)
         self.replace_paragraphs(j1, j2, new)
 
+    def replaced(self, i1, i2, n):
+        # Like removed, the interval is extended so that a paragraph
+        # which lost its NL is merged with the next one.
+        j1, j2 = self.get_envelope(i1, min(i2+1, len(self._layout)))
+        texel = self.extended_texel()
+        new = self.create_paragraphs(texel, j1, j2-(i2-i1)+n)
+        self.replace_paragraphs(j1, j2, new)
+
 
 
 def _create_testobjects(s):
@@ -372,3 +381,40 @@ def test_05():
     # ...
 
 
+
+
+def test_06():
+    "replaced after apply_edits"
+    import random
+    from ..textmodel.textmodel import TextModel
+    def rows(box):
+        if isinstance(box, Row):
+            return [''.join([child.text for child in box.childs])]
+        r = []
+        for child in box.childs:
+            r.extend(rows(child))
+        return r
+    for k in range(50):
+        model = TextModel(u"0123 456\n789\n\nabc def\n"*3)
+        builder = Builder(model, maxw=5)
+        builder.rebuild()
+        edits = []
+        i = 0
+        while True:
+            i1 = i+random.randrange(10)
+            i2 = i1+random.randrange(5)
+            if i2 > len(model):
+                break
+            edits.append((i1, i2, random.choice([u"", u"x", u"\n", u"y z\n"])))
+            i = i2
+        n0 = len(model)
+        model.apply_edits(edits)
+        if edits:
+            i1 = edits[0][0]
+            i2 = edits[-1][1]
+            builder.replaced(i1, i2, i2-i1+len(model)-n0)
+        layout = builder.get_layout()
+        expected = Builder(model, maxw=5)
+        expected.rebuild()
+        assert len(layout) == len(model)+1
+        assert rows(layout) == rows(expected.get_layout())
@@ -5,8 +5,10 @@ from __future__ import print_function
 from __future__ import absolute_import
 from ..textmodel.viewbase import ViewBase, overridable_property
 from ..textmodel.modelbase import Model
-from ..textmodel.textmodel import dump_range
+from ..textmodel.textmodel import dump_range, _Changes
 from ..textmodel import TextModel
+from ..textmodel.cursor import TexelCursor
+from ..textmodel.texeltree import diff
 from six.moves import range
 
 
@@ -34,6 +36,9 @@ class TextView(ViewBase, Model):
     _selection = None
     maxw = overridable_property('maxw')
     _maxw = 0
+    layout = overridable_property('layout')
+    _appended = None # deferred appends, see inserted
+    _adjust = False # adjust the viewport after the deferred appends
     _scrollrate = 10, 10
     _TextModel = TextModel
     def __init__(self):
@@ -51,8 +56,8 @@ class TextView(ViewBase, Model):
         self.rebuild()
 
     def rebuild(self):
+        self._appended = None
         self.builder.rebuild()
-        self.layout = self.builder.get_layout()
         self.refresh()
         assert self.layout is not None
 
@@ -154,6 +159,28 @@ class TextView(ViewBase, Model):
         info = self._set_styles, i1, styles
         self.add_undo(info)
 
+    def apply_styles(self, spans):
+        styles = self.model.apply_styles(spans)
+        if spans:
+            info = self._set_styles, spans[0][0], styles
+            self.add_undo(info)
+
+    def apply_edits(self, edits):
+        info = self._apply_edits(edits)
+        self.add_undo(info)
+
+    def _apply_edits(self, edits):
+        memo = self.model.apply_edits(edits)
+        return self._apply_edits, memo
+
+    def replace_all(self, pattern, replacement, i1=None, i2=None):
+        # All replacements are undone in one step. Returns the number
+        # of replaced matches.
+        memo = self.model.replace_all(pattern, replacement, i1, i2)
+        if memo:
+            self.add_undo((self._apply_edits, memo))
+        return len(memo)
+
     def _set_styles(self, i, styles):
         styles = self.model.set_styles(i, styles)
         return self._set_styles, i, styles
@@ -184,7 +211,17 @@ class TextView(ViewBase, Model):
         old = self.model.texel
         self.model.texel = new
         self.index = min(len(self.model), self.index)        
-        self.rebuild()
+        changes = diff(old, new)
+        if changes:
+            # Only the range covering all changes is rebuilt. Since
+            # builders may extend a change to the enclosing paragraph,
+            # the changes are passed as one.
+            i1 = changes[0][1]
+            i2 = changes[-1][2]
+            n = changes[-1][4]-changes[0][3]
+            if not self._flush_appended('replaced', (i1, i2, n)):
+                self.builder.replaced(i1, i2, n)
+            self.refresh()
         return self._set_texel, old
 
     def get_maxw(self):
@@ -194,8 +231,8 @@ class TextView(ViewBase, Model):
         if maxw == self._maxw:
             return
         self._maxw = maxw
+        self._flush_appended()
         self.builder.set_maxw(maxw)
-        self.layout = self.builder.get_layout()
         self.Refresh()
         self.notify_views('maxw_changed')
 
@@ -207,9 +244,10 @@ class TextView(ViewBase, Model):
         else:
             s1 = s2 = 0
         index = self.index
-        for line in range(lastrow, firstrow-1, -1): # indent
-            i = model.linestart(line)
-            model.insert_text(i, ' '*n)
+        edits = [(model.linestart(line), model.linestart(line), ' '*n)
+                 for line in range(firstrow, lastrow+1)]
+        model.apply_edits(edits)
+        for i, i2, spaces in reversed(edits):
             if index >= i:
                 index += n
             if s1 >= i:
@@ -229,14 +267,16 @@ class TextView(ViewBase, Model):
         else:
             s1 = s2 = 0
         index = self.index
-        memo = []
         model = self.model
-        for line in reversed(list(range(firstrow, lastrow+1))):
+        edits = []
+        for line in range(firstrow, lastrow+1):
             i = model.linestart(line)
             for j in range(i, i+n+1):
                 if j > len(model): break
                 if model.get_text(j, j+1) != ' ': break
-            memo.append(model.remove(i, j))
+            edits.append((i, j, u''))
+        memo = [old for j1, j2, old in reversed(model.apply_edits(edits))]
+        for i, j, empty in reversed(edits):
             if index > i:
                 index = i+max(0, index-j)
             if s1 > i:
@@ -257,11 +297,11 @@ class TextView(ViewBase, Model):
     def _undo_dedent(self, firstrow, memo, n):
         model = self.model
         lastrow = firstrow+len(memo)-1
-        memo = list(memo)
-        for line in reversed(list(range(firstrow, lastrow+1))):
+        edits = []
+        for line, old in zip(range(firstrow, lastrow+1), reversed(memo)):
             i = model.linestart(line)
-            model.insert(i, memo[0])
-            memo = memo[1:]
+            edits.append((i, i, old))
+        model.apply_edits(edits)
         return self._dedent_rows, firstrow, lastrow, n
 
     def compute_index(self, x, y):
@@ -282,9 +322,11 @@ class TextView(ViewBase, Model):
         model = self.model
         index = self.index
         layout = self.layout
-        style = self.current_style()
-        parstyle = model.get_parstyle(index)
-        row, col = self.current_position()
+        # style left of the cursor, see current_style
+        before, location = model.locate_many([max(0, index-1), index])
+        style = before.style
+        parstyle = location.parstyle
+        row, col = location.row, location.col
         rect = layout.get_rect(index, 0, 0)
         x = rect.x1
         y = rect.y1
@@ -316,28 +358,11 @@ class TextView(ViewBase, Model):
             row2 = model.index2position(s2)[0]
             self.dedent_rows(row1, row2)            
         elif action == 'move_word_end':
-            i = index
-            n = len(model)
-            try:
-                while not model.get_text(i, i+1).isalnum():
-                    i = i+1
-                while model.get_text(i, i+1).isalnum():
-                    i = i+1
-            except IndexError:
-                i = n
-            self.set_index(i, shift)
+            self.set_index(self.word_end(index), shift)
         elif action == 'move_right':
             self.set_index(index+1, shift)
         elif action == 'move_word_begin':
-            i = index
-            try:
-                while not model.get_text(i-1, i).isalnum():
-                    i = i-1
-                while model.get_text(i-1, i).isalnum():
-                    i = i-1
-            except IndexError:
-                i = 0
-            self.set_index(i, shift)
+            self.set_index(self.word_begin(index), shift)
         elif action == 'move_left':
             self.set_index(index-1, shift)
         elif action == 'move_paragraph_end':
@@ -427,16 +452,7 @@ class TextView(ViewBase, Model):
             self.to_clipboard(model[index:i])
             self.remove(index, i)
         elif action == 'del_word_left':
-            # find the beginning of the word
-            i = index
-            try:
-                while not model.get_text(i-1, i).isalnum():
-                    i = i-1
-                while model.get_text(i-1, i).isalnum():
-                    i = i-1
-            except IndexError:
-                i = 0
-            self.remove(i, index)
+            self.remove(self.word_begin(index), index)
         else:                  
             #print keycode
             assert len(action) == 1 # single character
@@ -477,28 +493,23 @@ class TextView(ViewBase, Model):
         i = self.layout.get_index(x, y)
         if i is None:
             return
-        model = self.model
-        n = len(model)
-        try:
-            while not model.get_text(i-1, i).isalnum():
-                i = i-1
-            while model.get_text(i-1, i).isalnum():
-                i = i-1
-        except IndexError:
-            i = 0
-        i1 = i
-        i = i1
-        try:
-            while not model.get_text(i, i+1).isalnum():
-                i = i+1
-            while model.get_text(i, i+1).isalnum():
-                i = i+1
-        except IndexError:
-            i = n
-        i2 = i
+        i1 = self.word_begin(i)
+        i2 = self.word_end(i1)
         self.index = i2
         self.selection = (i1, i2)
 
+    def word_begin(self, i):
+        """Returns the start of the word left of index *i*."""
+        cursor = TexelCursor(self.model, i)
+        cursor.skip_backward(lambda c: not c.isalnum())
+        return cursor.skip_backward(lambda c: c.isalnum())
+
+    def word_end(self, i):
+        """Returns the end of the word right of index *i*."""
+        cursor = TexelCursor(self.model, i)
+        cursor.skip_forward(lambda c: not c.isalnum())
+        return cursor.skip_forward(lambda c: c.isalnum())
+
     def refresh(self):
         raise NotImplemented()
 
@@ -506,19 +517,55 @@ class TextView(ViewBase, Model):
         from ..textmodel.treebase import is_root_efficient
         assert is_root_efficient(self.layout)
 
+    def get_layout(self):
+        self._flush_appended()
+        if self._adjust:
+            # the index was moved by deferred appends
+            self._adjust = False
+            self.adjust_viewport()
+        return self.builder.get_layout()
+
+    def _flush_appended(self, message=None, args=()):
+        # Passes the deferred appends and the change *message* to the
+        # builder. Returns False if no appends were deferred.
+        changes = self._appended
+        if changes is None:
+            return False
+        self._appended = None
+        if message is not None:
+            changes.record(message, args)
+        self.builder.replaced(*changes.get_signal())
+        return True
+
     ### Signals issued by model
     def properties_changed(self, model, i1, i2):
-        self.builder.properties_changed(i1, i2)
-        self.layout = self.builder.get_layout()
+        if not self._flush_appended('properties_changed', (i1, i2)):
+            self.builder.properties_changed(i1, i2)
         self.refresh()
 
     def inserted(self, model, i, n):
-        self.builder.inserted(i, n)
-        self.layout = self.builder.get_layout()
+        deferred = i+n == len(model)
+        if deferred:
+            # Appends are passed to the builder when the layout is
+            # needed, e.g. for painting. Many appends between two
+            # paints thus cost one update, and the model joins its
+            # appended content only once.
+            if self._appended is None:
+                self._appended = _Changes()
+            self._appended.record('inserted', (i, n))
+        elif not self._flush_appended('inserted', (i, n)):
+            self.builder.inserted(i, n)
         if debug:
             self.check()
         if i>= self.index:
-            self.index += n
+            if deferred:
+                # like set_index, but the viewport needs the layout
+                self._index += n
+                self.start_selection()
+                self._adjust = True
+                self.notify_views('index_changed')
+            else:
+                self.index += n
         if self._selection is not None:
             s1, s2 = self.selection
             if i >= s1:
@@ -528,9 +575,34 @@ class TextView(ViewBase, Model):
             self.selection = s1, s2
         self.refresh()
 
+    def replaced(self, model, i1, i2, n):
+        if not self._flush_appended('replaced', (i1, i2, n)):
+            self.builder.replaced(i1, i2, n)
+        if debug:
+            self.check()
+        delta = n-(i2-i1)
+        m = len(model)
+        index = self.index
+        if index >= i2:
+            self.index = index+delta
+        elif index > i1:
+            self.index = min(index, i1+n)
+        if self._selection is not None:
+            s1, s2 = self.selection
+            if s1 >= i2:
+                s1 += delta
+            elif s1 > i1:
+                s1 = min(s1, i1+n)
+            if s2 >= i2:
+                s2 += delta
+            elif s2 > i1:
+                s2 = min(s2, i1+n)
+            self.selection = min(s1, m), min(s2, m)
+        self.refresh()
+
     def removed(self, model, i, text):
-        self.builder.removed(i, len(text))
-        self.layout = self.builder.get_layout()
+        if not self._flush_appended('removed', (i, text)):
+            self.builder.removed(i, len(text))
         n = len(text)
         i1 = i
         i2 = i+n
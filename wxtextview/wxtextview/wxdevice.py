@@ -16,6 +16,15 @@ def filled(style, defaultstyle=defaultstyle):
     return new
 
 
+def style_key(style):
+    # Interned styles are identified by their id, other dicts by
+    # their items.
+    try:
+        return style.sid
+    except AttributeError:
+        return tuple(style.items())
+
+
 def invert_rect_INV(self, x, y, w, h, dc):
     if 1:
         dc.SetLogicalFunction(wx.INVERT)
@@ -64,7 +73,7 @@ _cache = dict()
 _cache_keys = []
 
 def measure_win(self, text, style):
-    key = text, tuple(style.items())
+    key = text, style_key(style)
     try:
         return _cache[key]
     except:
@@ -82,7 +91,7 @@ def measure_win(self, text, style):
     return w, h
 
 def measure_mac(self, text, style):
-    key = text, tuple(style.items())
+    key = text, style_key(style)
     try:
         return _cache[key]
     except:
@@ -100,7 +109,7 @@ def measure_mac(self, text, style):
     return w, h
 
 def measure_gtk(self, text, style):
-    key = text, tuple(style.items())
+    key = text, style_key(style)
     try:
         return _cache[key]
     except:
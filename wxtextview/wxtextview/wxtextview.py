@@ -373,6 +373,25 @@ def test_14():
     view.add_undo(view.remove(9, 10))
     assert len(view._undoinfo) == 1
 
+def test_15():
+    "deferred appends"
+    ns = init_testing(redirect=False)
+    model = ns['model']
+    view = ns['view']
+    view.index = len(model)
+    for i in range(100):
+        model.append_text(u"Line %i\n" % i)
+    assert model._tail is not None # not joined for the view
+    assert view.index == len(model)
+    model.remove(0, 5)
+    model.append_text(u"xyz")
+    model.insert_text(10, u"abc")
+    assert len(view.layout) == len(model)+1
+    height = view.layout.height
+    view.rebuild()
+    assert view.layout.height == height
+
+
 def demo_00():
     "simple demo"
     ns = test_02()